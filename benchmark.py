@@ -0,0 +1,200 @@
+"""
+Benchmarks for reading images and evaluating trigger functions, using synthetic .ims files (see `synthetic_ims.py`).
+
+For every image configuration (size, data type, chunking and compression), loading the image, calculating the
+z-projections (while reading and from the whole volume) and every registered trigger function are measured. Each
+measurement runs in its own process, so the peak memory (RSS) belongs to this measurement only. The results can be
+saved as a baseline and later runs compared against it to find regressions, e.g.:
+
+    python benchmark.py --save baseline.json
+    python benchmark.py --compare baseline.json
+"""
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import tempfile
+import itertools
+import multiprocessing
+import h5py
+import numpy as np
+from synthetic_ims import write_synthetic_ims
+
+sizes = {
+    "small": (16, 256, 256),
+    "medium": (32, 1024, 1024),
+    "large": (64, 2048, 2048),
+}
+compressions = {"gzip": "gzip", "lzf": "lzf", "none": None}
+
+
+def _peak_rss_mb():
+    # peak memory of this process in MB (None if it can not be measured on this system)
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # linux gives kB, macOS gives bytes
+        return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+    except ImportError:
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset / 1024 ** 2
+        except (ImportError, AttributeError):
+            return None
+
+
+def _operations():
+    # the measured operations, by name; each gets the path of the image
+    import image_cache
+    import trigger_registry
+    from get_current_image import imaris_image_reader, imaris_projection, get_current_image_2d
+
+    # the cache would make every repeat after the first one instantly, so it is switched off
+    image_cache.enabled = False
+    operations = {
+        "load": lambda path: imaris_image_reader(path, parallel=False),
+        "load parallel": lambda path: imaris_image_reader(path),
+        "projection": lambda path: get_current_image_2d(path=path),
+        # the projection of the whole volume, as it was calculated before `imaris_projection`, for comparison
+        "projection from volume": lambda path: np.max(imaris_image_reader(path), axis=2),
+        "mean projection": lambda path: imaris_projection(path, "mean"),
+        "max projection along x": lambda path: imaris_projection(path, axis=0),
+    }
+    for name in trigger_registry.registered_triggers():
+        operations[f"trigger {name}"] = (
+            lambda path, name=name: trigger_registry.evaluate(name, trigger_registry.ImageData(path)))
+    return operations
+
+
+def _measure(path, operation, repeats, results):
+    # runs in its own process: best wall time of all repeats and the peak memory
+    run = _operations()[operation]
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        run(path)
+        times.append(time.perf_counter() - start_time)
+    results.put({"seconds": min(times), "peak_rss_mb": _peak_rss_mb()})
+
+
+def measure(path, operation, repeats=3):
+    """
+    Measures one operation on one image in a new process. Returns the best wall time (s) and the peak RSS (MB), or
+    None if the operation failed (the error is printed by the process).
+    """
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure, args=(path, operation, repeats, results))
+    process.start()
+    try:
+        while True:
+            try:
+                return results.get(timeout=1)
+            except queue.Empty:
+                # the process ended without a result, i.e. the operation raised an exception
+                if process.exitcode is not None:
+                    print(f"{operation} failed (exit code {process.exitcode})")
+                    return None
+    finally:
+        process.join()
+
+
+def _chunks_label(path, requested_chunks):
+    # the chunks of the written file, as h5py chunks compressed data sets automatically if no chunks are given
+    with h5py.File(path, "r") as h5file:
+        chunks = h5file["DataSet/ResolutionLevel 0/TimePoint 0/Channel 0/Data"].chunks
+    if chunks is None:
+        return "none"
+    return "x".join(map(str, chunks)) + (" (auto)" if requested_chunks is None else "")
+
+
+def run_benchmarks(size_names, dtypes, chunkings, compression_names, repeats=3, operations=None):
+    """
+    Runs all benchmarks and returns the results as a list of dictionaries.
+    """
+    results = []
+    failed = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size_name, dtype, chunks, compression_name in itertools.product(size_names, dtypes, chunkings,
+                                                                            compression_names):
+            shape = sizes[size_name]
+            path = os.path.join(directory, "benchmark.ims")
+            write_synthetic_ims(path, shape, dtype, chunks, compressions[compression_name])
+            megabytes = np.prod(shape) * np.dtype(dtype).itemsize / 1024 ** 2
+            config = f"{size_name} {dtype} chunks {_chunks_label(path, chunks)} {compression_name}"
+            for operation in operations or _operations():
+                result = measure(path, operation, repeats)
+                if result is None:
+                    failed.append((config, operation))
+                    continue
+                result.update(config=config, operation=operation,
+                              throughput_mb_s=megabytes / result["seconds"] if result["seconds"] else None)
+                results.append(result)
+                print_result(result)
+    if failed:
+        print(f"\n{len(failed)} operation(s) failed:")
+        for config, operation in failed:
+            print(f"  {config}: {operation}")
+    return results
+
+
+def print_result(result, baseline=None):
+    peak = "-" if result["peak_rss_mb"] is None else f"{result['peak_rss_mb']:.0f}"
+    line = (f"{result['config']:<40} {result['operation']:<40} {result['seconds'] * 1000:10.1f} ms "
+            f"{result['throughput_mb_s'] or 0:10.1f} MB/s {peak:>8} MB peak RSS")
+    if baseline is not None:
+        line += f"  {result['seconds'] / baseline['seconds']:6.2f}x baseline time"
+    print(line)
+
+
+def compare(results, baseline_results, tolerance):
+    """
+    Compares the results with a baseline. Returns the results that are more than `tolerance` (fraction) slower.
+    """
+    baseline = {(result["config"], result["operation"]): result for result in baseline_results}
+    regressions = []
+    print("\nComparison with baseline:")
+    for result in results:
+        reference = baseline.get((result["config"], result["operation"]))
+        if reference is None:
+            continue
+        print_result(result, reference)
+        if result["seconds"] > reference["seconds"] * (1 + tolerance):
+            regressions.append(result)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark image reading and trigger functions.")
+    parser.add_argument("--sizes", nargs="+", default=["small", "medium"], choices=list(sizes))
+    parser.add_argument("--dtypes", nargs="+", default=["uint16"])
+    parser.add_argument("--chunks", nargs="+", default=["16x128x128", "8x32x32"],
+                        help="chunk shapes as ZxYxX, or none for contiguous data sets (small chunks, i.e. many "
+                             "chunks per image, show the overhead per chunk)")
+    parser.add_argument("--compressions", nargs="+", default=["gzip", "none"], choices=list(compressions))
+    parser.add_argument("--operations", nargs="+", default=None, help="only run these operations (default: all)")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--save", help="save the results as json (e.g. as a baseline)")
+    parser.add_argument("--compare", help="compare the results with a baseline json file")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="fraction an operation may be slower than the baseline before it is a regression")
+    args = parser.parse_args()
+
+    unknown = set(args.operations or []) - set(_operations())
+    if unknown:
+        parser.error(f"unknown operations: {', '.join(sorted(unknown))} (available: {', '.join(_operations())})")
+    chunkings = [None if chunks == "none" else tuple(int(c) for c in chunks.split("x")) for chunks in args.chunks]
+    all_results = run_benchmarks(args.sizes, args.dtypes, chunkings, args.compressions, args.repeats,
+                                 args.operations)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(all_results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            slower = compare(all_results, json.load(f), args.tolerance)
+        if slower:
+            print(f"\n{len(slower)} regression(s) slower than the baseline by more than {args.tolerance:.0%}:")
+            for regression in slower:
+                print(f"  {regression['config']}: {regression['operation']}")
+            sys.exit(1)
@@ -1,41 +1,62 @@
 import tkinter as tk
 from tkinter import ttk, simpledialog, messagebox
-import time
-import threading
-from requests.adapters import ConnectionError
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import os
+import difflib
 """
 from Andor on DF machine, but then modified
 """
 import fusionrest  # import functionality provided by Andor (and expanded for loading the last image)
-from get_current_image import get_current_image_2d  # import image loader functions
-import trigger_functions  # import trigger functions
+import trigger_registry  # trigger functions available in the dropdown menus
+import queue_simulator  # dry run of the queue based on the run history
+from queue_runner import QueueRunner, PrintColors  # runs the queue on a microscope
+import executor_process  # runs the queue in a separate process
 
 
-class PrintColors:
-    # for printing_in_colors
-    # from https://stackoverflow.com/questions/287871/how-do-i-print-colored-text-to-the-terminal 20th May 2025
-    HEADER = '\033[95m'
-    OKBLUE = '\033[94m'
-    OKCYAN = '\033[96m'
-    OKGREEN = '\033[92m'
-    WARNING = '\033[93m'
-    FAIL = '\033[91m'
-    ENDC = '\033[0m'
-    BOLD = '\033[1m'
-    UNDERLINE = '\033[4m'
+def parse_roi(roi_text, units):
+    """
+    Turns the roi text from the dialogs ("x0, x1, y0, y1" or "x0, x1, y0, y1, z0, z1") into a roi dict.
+    Returns None if no roi was given, raises a ValueError if the roi text can not be read.
+    """
+    if not roi_text.strip():
+        return None
+    bounds = [float(value) for value in roi_text.replace(";", ",").split(",")]
+    if len(bounds) not in (4, 6) or units not in ("pixel", "stage"):
+        raise ValueError
+    if any(start == stop for start, stop in zip(bounds[::2], bounds[1::2])):
+        # an empty region would not contain any pixels
+        raise ValueError
+    roi = {"units": units, "x": (bounds[0], bounds[1]), "y": (bounds[2], bounds[3])}
+    if len(bounds) == 6:
+        roi["z"] = (bounds[4], bounds[5])
+    return roi
+
+
+def show_roi_not_supported(func_name):
+    messagebox.showerror("Error", f"The trigger function {func_name} does not accept a region of interest. "
+                                  "Please clear the ROI or register the function with `register_trigger`.")
+
+
+def roi_to_string(roi):
+    # short description of a roi for the queue display
+    text = f"x {roi['x'][0]:g}-{roi['x'][1]:g}, y {roi['y'][0]:g}-{roi['y'][1]:g}"
+    if "z" in roi:
+        text += f", z {roi['z'][0]:g}-{roi['z'][1]:g}"
+    return f" ROI ({roi['units']}): {text}"
 
 
 class IfTriggerDialog(simpledialog.Dialog):
     """
-    Dialog asking for details on if trigger (trigger function, < or > and a trigger value).
+    Dialog asking for details on if trigger (trigger function, < or > and a trigger value) and optionally a region
+    of interest the trigger function is restricted to.
     """
     def body(self, master):
         ttk.Label(master, text="Condition (e.g., < or >):").grid(row=0, column=0)
         ttk.Label(master, text="Threshold:").grid(row=1, column=0)
         ttk.Label(master, text="Trigger Function:").grid(row=2, column=0)
+        ttk.Label(master, text="ROI x0, x1, y0, y1 (optional):").grid(row=3, column=0)
+        ttk.Label(master, text="ROI units:").grid(row=4, column=0)
 
         self.condition = ttk.Entry(master, width=5)
         self.condition.insert(0, "<")
@@ -50,16 +71,16 @@ class IfTriggerDialog(simpledialog.Dialog):
         self.trigger_function_menu.grid(row=2, column=1, padx=5)
 
         # Load functions only defined in trigger_functions.py (exclude imports)
-        import trigger_functions
-        import inspect
-        import types
-        self.trigger_funcs = {
-            name: func for name, func in inspect.getmembers(trigger_functions, inspect.isfunction)
-            if func.__module__ == trigger_functions.__name__
-        }
-        self.trigger_function_menu['values'] = list(self.trigger_funcs.keys())
+        self.trigger_funcs = trigger_registry.available_triggers()
+        self.trigger_function_menu['values'] = self.trigger_funcs
         if self.trigger_funcs:
-            self.trigger_function_menu.set(list(self.trigger_funcs.keys())[0])
+            self.trigger_function_menu.set(self.trigger_funcs[0])
+
+        self.roi = ttk.Entry(master, width=30)
+        self.roi.grid(row=3, column=1, padx=5)
+        self.roi_units_var = tk.StringVar(value="pixel")
+        ttk.Combobox(master, textvariable=self.roi_units_var, values=["pixel", "stage"], width=10,
+                     state="readonly").grid(row=4, column=1, padx=5, sticky=tk.W)
 
         return self.condition  # initial focus
 
@@ -68,12 +89,18 @@ class IfTriggerDialog(simpledialog.Dialog):
             condition = self.condition.get()
             threshold = float(self.threshold.get())
             trigger_func_name = self.trigger_function_var.get()
+            roi = parse_roi(self.roi.get(), self.roi_units_var.get())
+            if roi is not None and not trigger_registry.accepts_roi(trigger_func_name):
+                show_roi_not_supported(trigger_func_name)
+                self.result = None
+                return
             if condition in ("<", ">") and trigger_func_name:
                 self.result = {
                     "trigger": {
                         "condition": condition,
                         "threshold": threshold,
-                        "function_name": trigger_func_name
+                        "function_name": trigger_func_name,
+                        "roi": roi
                     }
                 }
             else:
@@ -86,7 +113,7 @@ class IfTriggerDialog(simpledialog.Dialog):
 class LoopDialog(simpledialog.Dialog):
     """
     Dialog asking for details on nested loop (repeats, duration, if a trigger should be added and if yes,
-    with what conditions (trigger function, < or > and a trigger value).
+    with what conditions (trigger function, < or > and a trigger value) and optionally a region of interest).
     """
     def body(self, master):
         ttk.Label(master, text="Repeats:").grid(row=0)
@@ -100,10 +127,7 @@ class LoopDialog(simpledialog.Dialog):
         self.trigger_checkbox.pack(side=tk.LEFT)
 
         # Load trigger functions from the trigger_functions module
-        self.trigger_funcs = []
-        for name, func in trigger_functions.__dict__.items():
-            if callable(func) and func.__module__ == 'trigger_functions' and not name.startswith("_"):
-                self.trigger_funcs.append(name)
+        self.trigger_funcs = trigger_registry.available_triggers()
 
         self.trigger_func_var = tk.StringVar(value=self.trigger_funcs[0] if self.trigger_funcs else "")
 
@@ -117,9 +141,32 @@ class LoopDialog(simpledialog.Dialog):
         self.condition.pack(side=tk.LEFT, padx=2)
         self.threshold.pack(side=tk.LEFT, padx=2)
 
+        # optional region of interest for the trigger function
+        self.roi_frame = ttk.Frame(master)
+        ttk.Label(self.roi_frame, text="ROI x0, x1, y0, y1 (optional):").pack(side=tk.LEFT)
+        self.roi = ttk.Entry(self.roi_frame, width=25)
+        self.roi_units_var = tk.StringVar(value="pixel")
+        self.roi_units_menu = ttk.Combobox(self.roi_frame, textvariable=self.roi_units_var,
+                                           values=["pixel", "stage"], width=8, state="readonly")
+        self.roi.pack(side=tk.LEFT, padx=2)
+        self.roi_units_menu.pack(side=tk.LEFT, padx=2)
+
+        # optional pipelining: analyze the image of one iteration while the next iteration is already acquired
+        self.pipeline_frame = ttk.Frame(master)
+        self.pipelined_var = tk.IntVar()
+        self.pipelined_checkbox = ttk.Checkbutton(self.pipeline_frame, text="Analyze while acquiring next iteration",
+                                                  variable=self.pipelined_var)
+        ttk.Label(self.pipeline_frame, text="Max. lag (iterations):").pack(side=tk.RIGHT)
+        self.lag = ttk.Entry(self.pipeline_frame, width=5)
+        self.lag.insert(0, "1")
+        self.pipelined_checkbox.pack(side=tk.LEFT)
+        self.lag.pack(side=tk.RIGHT, padx=2)
+
         self.repeats.grid(row=0, column=1)
         self.interval.grid(row=1, column=1)
         self.trigger_frame.grid(row=2, columnspan=2, pady=5)
+        self.roi_frame.grid(row=3, columnspan=2, pady=5)
+        self.pipeline_frame.grid(row=4, columnspan=2, pady=5)
         return self.repeats
 
     def toggle_trigger(self):
@@ -127,6 +174,10 @@ class LoopDialog(simpledialog.Dialog):
         self.condition.configure(state=state)
         self.threshold.configure(state=state)
         self.trigger_func_menu.configure(state=state)
+        self.roi.configure(state=state)
+        self.roi_units_menu.configure(state=state)
+        self.pipelined_checkbox.configure(state=state)
+        self.lag.configure(state=state)
 
     def apply(self):
         try:
@@ -139,11 +190,20 @@ class LoopDialog(simpledialog.Dialog):
                 threshold = float(self.threshold.get())
                 condition = self.condition.get()
                 trigger_func = self.trigger_func_var.get()
-                if condition in ('<', '>') and trigger_func:
+                roi = parse_roi(self.roi.get(), self.roi_units_var.get())
+                lag = int(self.lag.get())
+                if roi is not None and not trigger_registry.accepts_roi(trigger_func):
+                    show_roi_not_supported(trigger_func)
+                    self.result = None
+                    return
+                if condition in ('<', '>') and trigger_func and lag >= 0:
                     self.result["trigger"] = {
                         "function": trigger_func,
                         "threshold": threshold,
-                        "condition": condition
+                        "condition": condition,
+                        "roi": roi,
+                        "pipelined": bool(self.pipelined_var.get()),
+                        "lag": lag
                     }
         except ValueError:
             messagebox.showerror("Error", "Invalid input. Please check your values.")
@@ -156,18 +216,30 @@ class FunctionLooperApp(tk.Tk):
     """
     def __init__(self):
         super().__init__()
-        self.start_time_global = time.time()  # set a start time, it will be overwritten when the main loop is started
         self.title("Function Queue Looper with Adjusted Loop Timing")
-        self.geometry("700x500")
+        self.geometry("700x540")
 
         self.queue = []
-        self.running = False
-
-        self.current_nesting = 0
+        self.runners = []  # one queue runner per microscope while the loop is running
+        self.clients = {}  # Fusion clients by "host:port", so each microscope keeps its session and protocol list
+        # optionally, the queue runs in a separate process, so image analysis does not slow down the GUI
+        self.separate_process = tk.BooleanVar(value=False)
+        self.executor = None
+        self.executor_runners = 0  # number of runners in the separate process that have not finished yet
+        self.status = tk.StringVar(value="")  # current step and last trigger result of the running loop
 
         self.repeat_count = tk.IntVar(value=1)
         self.main_interval = tk.DoubleVar(value=0.0)
 
+        # deadlines for protocols (0 means no deadline) and what to do if a protocol fails
+        self.start_timeout = tk.DoubleVar(value=60.0)
+        self.run_timeout = tk.DoubleVar(value=0.0)
+        self.failure_policy = tk.StringVar(value="skip")
+        self.retries = tk.IntVar(value=1)
+
+        # Fusion instances the queue runs on, several instances run the queue at the same time
+        self.fusion_instances = tk.StringVar(value=f"{fusionrest.host}:{fusionrest.port}")
+
         self.create_widgets()
 
     def create_widgets(self):
@@ -181,11 +253,11 @@ class FunctionLooperApp(tk.Tk):
             "func", self.wait_until_idle, label="Wait until idle")).pack(side=tk.LEFT, padx=5)
         """
         ttk.Button(button_frame, text="Get Progress", command=lambda: self.add_to_queue(
-            "func", self.get_progress, label="Get progress")).pack(side=tk.LEFT, padx=5)
+            "func", label="Get progress", action=("progress",))).pack(side=tk.LEFT, padx=5)
         # In the create_widgets method
         ttk.Button(button_frame, text="Show z-projection",
-                   command=lambda: self.add_to_queue("func", self.show_z_projection,
-                                                     label="Show z-projection")).pack(side=tk.LEFT, padx=5)
+                   command=lambda: self.add_to_queue("func", label="Show z-projection",
+                                                     action=("z_projection",))).pack(side=tk.LEFT, padx=5)
         ttk.Button(button_frame, text="Wait", command=self.add_waiting_time).pack(side=tk.LEFT, padx=5)
 
         # Inner loop controls
@@ -211,6 +283,23 @@ class FunctionLooperApp(tk.Tk):
         ttk.Label(control_frame, text="Main Interval (s):").grid(row=0, column=2)
         ttk.Entry(control_frame, textvariable=self.main_interval, width=5).grid(row=0, column=3, padx=5)
 
+        ttk.Label(control_frame, text="Start timeout (s):").grid(row=1, column=0, padx=5, pady=5)
+        ttk.Entry(control_frame, textvariable=self.start_timeout, width=5).grid(row=1, column=1)
+
+        ttk.Label(control_frame, text="Protocol timeout (s, 0 = none):").grid(row=1, column=2)
+        ttk.Entry(control_frame, textvariable=self.run_timeout, width=5).grid(row=1, column=3, padx=5)
+
+        ttk.Label(control_frame, text="On failure:").grid(row=1, column=4)
+        ttk.Combobox(control_frame, textvariable=self.failure_policy, values=["skip", "retry", "abort"], width=6,
+                     state="readonly").grid(row=1, column=5, padx=5)
+
+        ttk.Label(control_frame, text="Retries:").grid(row=1, column=6)
+        ttk.Spinbox(control_frame, from_=1, to=10, textvariable=self.retries, width=3).grid(row=1, column=7, padx=5)
+
+        ttk.Label(control_frame, text="Fusion (host:port, comma separated):").grid(row=2, column=0, columnspan=3)
+        ttk.Entry(control_frame, textvariable=self.fusion_instances, width=40).grid(row=2, column=3, columnspan=5,
+                                                                                   padx=5, sticky=tk.W)
+
         # Action buttons
         action_frame = ttk.Frame(self)
         action_frame.pack(pady=15)
@@ -218,17 +307,38 @@ class FunctionLooperApp(tk.Tk):
         ttk.Button(action_frame, text="Start Loop", command=self.start_loop).pack(side=tk.LEFT, padx=5)
         ttk.Button(action_frame, text="Stop", command=self.stop_loop).pack(side=tk.LEFT, padx=5)
         ttk.Button(action_frame, text="Clear Queue", command=self.clear_queue).pack(side=tk.LEFT, padx=5)
+        ttk.Button(action_frame, text="Dry Run", command=self.dry_run).pack(side=tk.LEFT, padx=5)
+        ttk.Button(action_frame, text="Pause", command=self.pause_loop).pack(side=tk.LEFT, padx=5)
+        ttk.Button(action_frame, text="Resume", command=self.resume_loop).pack(side=tk.LEFT, padx=5)
+        ttk.Checkbutton(action_frame, text="Separate process",
+                        variable=self.separate_process).pack(side=tk.LEFT, padx=5)
+
+        ttk.Label(self, textvariable=self.status).pack()
 
     def add_protocol(self):
         protocol_text = simpledialog.askstring("Protocol Input", "Enter protocol name [case sensitive]:")
         if protocol_text:
-            self.add_to_queue("func", lambda: self.set_protocol(protocol_text),
-                              label=f"Protocol: {protocol_text}")
+            # check the name against the protocols known to Fusion, so typos are found before the loop runs
+            for client in self.get_clients() or []:
+                known = client.is_known_protocol(protocol_text)
+                if known is None:
+                    print(f"{PrintColors.WARNING}Could not get the list of protocols from Fusion at "
+                          f"{client.host}:{client.port}, protocol name {protocol_text} was not checked."
+                          f"{PrintColors.ENDC}")
+                elif not known:
+                    suggestions = difflib.get_close_matches(protocol_text, client.get_protocol_names())
+                    message = f"Fusion at {client.host}:{client.port} does not know a protocol named {protocol_text}."
+                    if suggestions:
+                        message += " Did you mean: " + ", ".join(suggestions) + "?"
+                    # the list of protocols might be incomplete, so the name can still be added
+                    if not messagebox.askyesno("Unknown protocol", message + "\n\nAdd it anyway?"):
+                        return
+            self.add_to_queue("func", label=f"Protocol: {protocol_text}", action=("protocol", protocol_text))
 
     def add_waiting_time(self):
         waiting_time = simpledialog.askfloat("Waiting time", "Enter the waiting time (s):")
         if waiting_time:
-            self.add_to_queue("func", lambda: self.wait(waiting_time), label=f"Waiting for {str(waiting_time)} s")
+            self.add_to_queue("func", label=f"Waiting for {str(waiting_time)} s", action=("wait", waiting_time))
 
     def add_inner_loop_start(self):
         dialog = LoopDialog(self, title="Start Inner Loop")
@@ -243,8 +353,10 @@ class FunctionLooperApp(tk.Tk):
         if dialog.result:
             self.add_to_queue("loop_start", {"trigger": dialog.result['trigger'], "is_conditional": True})
 
-    def add_to_queue(self, item_type, value=None, label=None):
-        self.queue.append({'type': item_type, 'value': value, 'label': label, 'is_conditional':False})
+    def add_to_queue(self, item_type, value=None, label=None, action=None):
+        # action describes what a function item does, e.g. ("protocol", name) or ("wait", seconds), see QueueRunner
+        self.queue.append({'type': item_type, 'value': value, 'label': label, 'is_conditional':False,
+                           'action': action})
         self.update_queue_display()
 
     def remove_last_item(self):
@@ -262,7 +374,7 @@ class FunctionLooperApp(tk.Tk):
                 indent -= 2
             line = " " * indent
             if item['type'] == 'func':
-                line += f"- {item.get('label', item['value'].__name__)}"
+                line += f"- {item.get('label') or item['value'].__name__}"
             elif item['type'] == 'trigger':
                 line += f"- {item.get('label')}"
             elif item['type'] == 'loop_start':
@@ -270,11 +382,17 @@ class FunctionLooperApp(tk.Tk):
                 if 'is_conditional' in loop_info and loop_info['is_conditional']:
                     trigger = loop_info['trigger']
                     line += f" If trigger: {trigger['condition']} {trigger['threshold']}"
+                    if trigger.get('roi'):
+                        line += roi_to_string(trigger['roi'])
                 else:
                     line += f"[ Start Loop x{loop_info.get('count', 1)}, Interval {loop_info.get('interval', 0)}s ]"
                     if loop_info.get('trigger'):
                         trigger = loop_info['trigger']
                         line += f" Trigger: {trigger['condition']} {trigger['threshold']}"
+                        if trigger.get('roi'):
+                            line += roi_to_string(trigger['roi'])
+                        if trigger.get('pipelined'):
+                            line += f" (pipelined, lag {trigger.get('lag', 1)})"
                 indent += 2
             elif item['type'] == 'loop_end':
                 line += "[ End Loop ]"
@@ -286,183 +404,140 @@ class FunctionLooperApp(tk.Tk):
         self.queue = []
         self.update_queue_display()
 
+    def get_clients(self):
+        # get the Fusion clients for all instances in the "host:port, host:port" entry (None if it can not be read)
+        clients = []
+        try:
+            for instance in self.fusion_instances.get().split(","):
+                host, port = instance.strip().rsplit(":", 1)
+                key = f"{host}:{int(port)}"
+                if key not in self.clients:
+                    self.clients[key] = fusionrest.FusionClient(host, int(port))
+                clients.append(self.clients[key])
+        except ValueError:
+            messagebox.showerror("Error", "Invalid Fusion instances, please use host:port, separated by commas.")
+            return None
+        return clients
+
+    def is_running(self):
+        return self.executor_runners > 0 or any(runner.running for runner in self.runners)
+
     def start_loop(self):
         # if the queue is empty or something is already running, don't do anything when this button is pressed
-        if not self.queue or self.running:
+        if not self.queue or self.is_running():
             return
-        # otherwise start running the main loop queue
-        self.running = True
-        self.start_time_global = time.time()
-        threading.Thread(target=self.run_main_loop, daemon=True).start()
-
-    def stop_loop(self):
-        # stop the main loop by setting self.running to false if the stop button is pressed
-        self.running = False
-        # also stop the microscope
-        fusionrest.stop()
-
-    def run_main_loop(self):
-        # run the main loop: get the start time for each loop interval, run the complete queue, wait if necessary
-        for _ in range(self.repeat_count.get()):
-            if not self.running:
-                break
-            start_time = time.time()
-            self.run_queue(self.queue)
-            elapsed = time.time() - start_time
-            wait_time = max(0, self.main_interval.get() - elapsed)
-            if self.running and wait_time > 0:
-                print(f"Waiting {wait_time:.2f} seconds to maintain main loop interval.")
-                time.sleep(wait_time)
-        self.running = False
-        print(f"{PrintColors.OKGREEN}Main loop completed or stopped.{PrintColors.ENDC}")
-        print(f"{PrintColors.OKGREEN}Running everything took "
-              + str(round(time.time() - self.start_time_global, 1))
-              + f" seconds{PrintColors.ENDC}")
-
-    def check_trigger(self, func_name, condition, threshold):
-        # check if the trigger condition was met, if yes return true
+        clients = self.get_clients()
+        if not clients:
+            return
+        # otherwise start running the main loop queue, on each microscope independently
+        settings = [
+            dict(queue=list(self.queue), repeat_count=self.repeat_count.get(), main_interval=self.main_interval.get(),
+                 start_timeout=self.start_timeout.get(), run_timeout=self.run_timeout.get(),
+                 failure_policy=self.failure_policy.get(), retries=self.retries.get(),
+                 name=f"{client.host}:{client.port}" if len(clients) > 1 else None)
+            for client in clients
+        ]
+        if self.separate_process.get():
+            if self.executor is None:
+                self.executor = executor_process.ExecutorProcess()
+            self.runners = []
+            self.executor_runners = len(clients)
+            self.executor.start([dict(host=client.host, port=client.port, **runner_settings)
+                                 for client, runner_settings in zip(clients, settings)])
+            self.after(100, self.poll_executor_events)
+        else:
+            self.runners = [QueueRunner(client, on_projection=self.show_z_projection,
+                                        on_event=lambda event: self.after(0, self.show_event, event),
+                                        **runner_settings)
+                            for client, runner_settings in zip(clients, settings)]
+            for runner in self.runners:
+                runner.start()
+
+    def poll_executor_events(self):
+        # handle the events of the separate process, this runs on the main thread (and repeats while it is running)
         try:
-            func = getattr(trigger_functions, func_name)
-            value = func()
-            if (condition == '<' and value < threshold) or (condition == '>' and value > threshold):
-                print("  " * self.current_nesting +
-                      f"{PrintColors.OKCYAN}TRIGGER MET: {value:.2f} {condition} {threshold}{PrintColors.ENDC}")
-                return True
-            else:
-                print("  " * self.current_nesting
-                      + f"Trigger not met, trigger function {func_name} returned value: {value:.2f}")
-            return False
-        except Exception as e:
-            print(f"{PrintColors.FAIL}Error executing trigger function {func_name}: {e}{PrintColors.ENDC}")
-            return False
-
-    def run_queue(self, queue, depth=0):
-        # run the queue that was set up
-        index = 0
-        # if the index has not reached the queue length, execute the next item in the queue
-        while index < len(queue):
-            if not self.running:
-                break
-
-            # get the next item in the queue
-            item = queue[index]
-
-            # if the next item type is a function, execute it
-            if item['type'] == 'func':
-                self.current_nesting = depth
-                print("  " * depth +
-                      f"{PrintColors.BOLD}Executing: {item.get('label', item['value'].__name__)}{PrintColors.ENDC}, "
-                      + f"start time: {time.strftime('%a %H:%M:%S')}")
-                item['value']()
-
-
-            elif item['type'] == 'loop_start':
-                if item['value'].get('is_conditional'):
-                    loop_info = item['value']
-                    loop_body = []
-                    nest = 1
-                    index += 1
-                    while index < len(queue) and nest > 0:
-                        if queue[index]['type'] == 'loop_start':
-                            nest += 1
-                        elif queue[index]['type'] == 'loop_end':
-                            nest -= 1
-                        if nest > 0:
-                            loop_body.append(queue[index])
-                        index += 1
-                    trigger = loop_info.get('trigger', {})
-
-                    should_run = self.check_trigger(
-                        trigger.get('function_name'),
-                        trigger.get('condition'),
-                        trigger.get('threshold')
-                    )
-
-                    if should_run:
-                        self.run_queue(loop_body, depth + 1)
-
-                    continue
-
+            for event in self.executor.get_events():
+                if event["type"] == "projection":
+                    self.show_projection_event(event)
                 else:
-
-                    # get loop count, interval, trigger [if any] and "nesting level"
-                    loop_count = item['value'].get('count', 1)
-                    loop_interval = item['value'].get('interval', 0)
-                    loop_trigger = item['value'].get('trigger', None)
-                    inner_queue = []
-                    nest = 1
-                    index += 1
-
-                    # go to the next nesting level of the new loop
-                    while index < len(queue) and nest > 0:
-                        if queue[index]['type'] == 'loop_start':
-                            nest += 1
-                        elif queue[index]['type'] == 'loop_end':
-                            nest -= 1
-                        # if the loop is nested, add it to the list of inner queue
-                        if nest > 0:
-                            inner_queue.append(queue[index])
-                        # increase the index as this item of the queue is handled (have to increase it here, as the
-                        # inner loop uses continue, so it's not increased otherwise if there is an inner loop started
-                        index += 1
-
-                    # start the inner loop
-                    for _ in range(loop_count):
-                        # get the start time to keep track of time
-                        start_time = time.time()
-                        # run the inner queue (this is a recursive function call)
-                        self.run_queue(inner_queue, depth + 1)
-
-                        # check if the trigger condition was met
-                        if loop_trigger and self.check_trigger(loop_trigger['function'], loop_trigger['condition'],
-                                                               loop_trigger['threshold']):
-                            break
-                        # check how much time has elapsed since start, calculate the wait time (if any)
-                        # if the loop took longer thant he outer loop says it should, immediately continue
-                        # for this also have to add one indent to the depth level for printing, as otherwise it is less
-                        # indented than the loop that was executed
-                        elapsed = time.time() - start_time
-                        wait_time = max(0, loop_interval - elapsed)
-                        if self.running and wait_time > 0:
-                            print("  " * (depth + 1)
-                                  + f"Waiting {wait_time:.2f} seconds for nested loop interval.")
-                            time.sleep(wait_time)
-                        else:
-                            print("  " * (depth + 1)
-                                  + f"{PrintColors.WARNING}Not waiting, as this nested loop took",
-                                  round(elapsed, 2),
-                                  f"seconds{PrintColors.ENDC}")
-                        if not self.running:
-                            break
-                    continue
-            # increase the index for everything, except for loop start (this is handled above)
-            index += 1
-
-    def set_protocol(self, protocol):
-        # using the Andor function to set a protocol given the protocol name as a string
-        try:
-            fusionrest.run_protocol_completely(protocol)
-            # print(f"Running protocol: {protocol}")
-        except ConnectionError:
-            print("  " * self.current_nesting
-                  + f"{PrintColors.FAIL}No connection to microscope.{PrintColors.ENDC}")
-
-    def get_progress(self):
-        # print the progress in the console window
+                    self.show_event(event)
+                if event["type"] == "finished":
+                    self.executor_runners -= 1
+            if not self.executor.process.is_alive():
+                print(f"{PrintColors.FAIL}The separate process ended unexpectedly.{PrintColors.ENDC}")
+                self.executor = None
+                self.executor_runners = 0
+        finally:
+            if self.executor_runners > 0:
+                self.after(100, self.poll_executor_events)
+
+    def show_event(self, event):
+        # show the current step, the last trigger result or the end of the loop in the status line
+        prefix = f"[{event['runner']}] " if event.get("runner") else ""
+        if event["type"] == "step":
+            self.status.set(prefix + f"Executing: {event['label']}")
+        elif event["type"] == "trigger":
+            result = "met" if event["met"] else "not met"
+            self.status.set(prefix + f"Trigger {event['function']}: {event['value']:.2f} ({result})")
+        elif event["type"] == "finished":
+            self.status.set(prefix + f"Finished after {event['seconds']:.1f} s")
+
+    def show_projection_event(self, event):
+        # read the z-projection from shared memory, the executor frees it once it is released
         try:
-            progress = fusionrest.get_protocol_progress()
-            print(progress)
-        except ConnectionError:
-            print("  " * self.current_nesting +
-                  f"{PrintColors.FAIL}No connection to microscope.{PrintColors.ENDC}")
-
-    def wait(self, waiting_time):
-        # wait for a certain amount of time (waiting time in s)
-        time.sleep(waiting_time)
-        return
+            z_proj = executor_process.read_projection(event)
+        except FileNotFoundError:
+            print(f"{PrintColors.WARNING}The z-projection is no longer available.{PrintColors.ENDC}")
+            return
+        finally:
+            self.executor.release(event)
+        self.display_z_projection(z_proj)
+
+    def pause_loop(self):
+        # pause the main loops after the current step
+        if self.executor_runners > 0:
+            self.executor.pause()
+        for runner in self.runners:
+            runner.pause()
+
+    def resume_loop(self):
+        if self.executor_runners > 0:
+            self.executor.resume()
+        for runner in self.runners:
+            runner.resume()
+
+    def dry_run(self):
+        # predict how long running the queue will take (based on the run history) without using the microscope
+        if not self.queue:
+            return
+        total_duration, warnings = queue_simulator.simulate(self.queue, self.repeat_count.get(),
+                                                            self.main_interval.get())
+        print(f"{PrintColors.HEADER}Dry run: the queue is expected to take {total_duration:.1f} seconds "
+              f"({total_duration / 3600:.2f} h){PrintColors.ENDC}")
+        for warning in warnings:
+            print(f"  {PrintColors.WARNING}{warning}{PrintColors.ENDC}")
+
+    def stop_loop(self):
+        # stop the main loops if the stop button is pressed, this also stops the microscopes
+        if self.executor_runners > 0:
+            self.executor.stop()
+        elif self.runners:
+            for runner in self.runners:
+                runner.stop()
+        else:
+            for client in self.get_clients() or []:
+                client.stop()
+
+    def close(self):
+        # also end the separate process (if it was started) when the window is closed
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.destroy()
 
     def display_z_projection(self, z_proj):
-        fig, ax = plt.subplots(figsize=(4, 4))
+        # using a Figure instead of pyplot, so the old figures are not kept in pyplot's list of open figures
+        fig = Figure(figsize=(4, 4))
+        ax = fig.add_subplot()
         ax.imshow(z_proj, cmap='gray')
         ax.set_title("z-projection of last image")
         ax.axis('off')
@@ -474,26 +549,16 @@ class FunctionLooperApp(tk.Tk):
         canvas.draw()
         return
 
-    def show_z_projection(self):
-        # show the z-projection of the last image that was acquired
-        try:
-            z_proj = get_current_image_2d()
-            # using after to run this 'after 0 ms' on the main thread to prevent instability issues as this thread
-            # does not own the event loop, after also ensures that this is only done if the main thread is free.
-            self.after(0, self.display_z_projection, z_proj)
-
-        except ConnectionError:
-            """
-            # tested when there was no connection via:
-            import numpy as np
-            z_proj = np.random.rand(2, 2)
-            self.after(0, self.display_z_projection, z_proj)
-            """
-            print("  " * self.current_nesting + f"{PrintColors.FAIL}No connection to microscope.{PrintColors.ENDC}")
+    def show_z_projection(self, z_proj):
+        # show the z-projection of the last image that was acquired (called from the thread running the queue)
+        # using after to run this 'after 0 ms' on the main thread to prevent instability issues as this thread
+        # does not own the event loop, after also ensures that this is only done if the main thread is free.
+        self.after(0, self.display_z_projection, z_proj)
 
 
 if __name__ == "__main__":
     # set the colour display to work nicely
     os.system("color")
     app = FunctionLooperApp()
+    app.protocol("WM_DELETE_WINDOW", app.close)
     app.mainloop()
@@ -0,0 +1,169 @@
+"""
+Runs queues in a separate process, so reading and analyzing images does not compete with the GUI for the GIL.
+
+The GUI sends commands ("start", "pause", "resume", "stop", "shutdown") over a pipe and gets the events of the
+queue runners (steps, trigger results, z-projections, finished) from a queue. Z-projections are not sent through the
+queue, they are written to shared memory and only the name, shape and data type of the shared memory block are sent.
+The executor frees a block when the GUI releases it after reading (or at shutdown).
+"""
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+import queue
+import numpy as np
+
+
+def _attach_shared_memory(name):
+    # python >= 3.13 can attach without registering the block with the resource tracker of this process (which would
+    # otherwise try to clean it up when the GUI closes, although the executor process owns it)
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        block = shared_memory.SharedMemory(name=name)
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(block._name, "shared_memory")
+        except (ImportError, AttributeError):
+            pass  # windows has no resource tracker for shared memory
+        return block
+
+
+def read_projection(event):
+    """
+    Copies the z-projection of a "projection" event out of shared memory.
+    """
+    block = _attach_shared_memory(event["name"])
+    try:
+        return np.ndarray(event["shape"], dtype=event["dtype"], buffer=block.buf).copy()
+    finally:
+        block.close()
+
+
+class _SharedProjections:
+    # writes z-projections to new shared memory blocks, which are kept until the GUI released them
+    def __init__(self, events):
+        self.events = events
+        self.blocks = {}
+        self.lock = threading.Lock()
+
+    def send(self, runner_name, projection):
+        projection = np.ascontiguousarray(projection)
+        with self.lock:
+            block = shared_memory.SharedMemory(create=True, size=max(projection.nbytes, 1))
+            np.ndarray(projection.shape, dtype=projection.dtype, buffer=block.buf)[...] = projection
+            self.blocks[block.name] = block
+        self.events.put({"type": "projection", "runner": runner_name, "name": block.name,
+                         "shape": projection.shape, "dtype": projection.dtype.str})
+
+    @staticmethod
+    def _free(block):
+        block.close()
+        block.unlink()
+
+    def release(self, name):
+        with self.lock:
+            block = self.blocks.pop(name, None)
+        if block is not None:
+            self._free(block)
+
+    def free_all(self):
+        with self.lock:
+            blocks, self.blocks = list(self.blocks.values()), {}
+        for block in blocks:
+            self._free(block)
+
+
+def _make_runner(settings, projections, events):
+    # queue runner for one microscope, sending its events and z-projections to the GUI
+    import fusionrest
+    from queue_runner import QueueRunner
+
+    settings = dict(settings)
+    client = fusionrest.FusionClient(settings.pop("host"), settings.pop("port"))
+    name = settings.get("name")
+    return QueueRunner(client, on_projection=lambda projection: projections.send(name, projection),
+                       on_event=events.put, **settings)
+
+
+def _executor_main(commands, events):
+    # main function of the executor process: execute the commands sent by the GUI
+    projections = _SharedProjections(events)
+    runners = []
+    while True:
+        try:
+            command, argument = commands.recv()
+        except EOFError:
+            # the GUI ended without shutting down this process
+            command, argument = "shutdown", None
+        if command == "shutdown":
+            for runner in runners:
+                runner.running = False
+                runner.resume()
+            projections.free_all()
+            return
+        try:
+            if command == "start" and not any(runner.running for runner in runners):
+                runners = [_make_runner(settings, projections, events) for settings in argument]
+                for runner in runners:
+                    runner.start()
+            elif command == "pause":
+                for runner in runners:
+                    runner.pause()
+            elif command == "resume":
+                for runner in runners:
+                    runner.resume()
+            elif command == "stop":
+                for runner in runners:
+                    runner.stop()
+            elif command == "release":
+                projections.release(argument)
+        except Exception as e:
+            # a failing command must not end the process (and with it all runners)
+            from queue_runner import PrintColors
+            print(f"{PrintColors.FAIL}Executor command {command} failed: {e}{PrintColors.ENDC}")
+
+
+class ExecutorProcess:
+    """
+    Separate process running queues, controlled by the GUI.
+
+    `start` gets a list of settings, one dictionary per microscope with "host", "port" and the arguments of
+    `QueueRunner` (queue, repeat_count, main_interval, ...). The events of the runners are read with `get_events`.
+    """
+    def __init__(self):
+        self.commands, child_commands = multiprocessing.Pipe()
+        self.events = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=_executor_main, args=(child_commands, self.events),
+                                               daemon=True)
+        self.process.start()
+
+    def start(self, runner_settings):
+        self.commands.send(("start", runner_settings))
+
+    def pause(self):
+        self.commands.send(("pause", None))
+
+    def resume(self):
+        self.commands.send(("resume", None))
+
+    def stop(self):
+        self.commands.send(("stop", None))
+
+    def release(self, event):
+        # the z-projection of this event was read (or could not be read), so its shared memory can be freed
+        self.commands.send(("release", event["name"]))
+
+    def shutdown(self):
+        self.commands.send(("shutdown", None))
+        self.process.join(timeout=5)
+
+    def get_events(self):
+        """
+        Returns all events that arrived since the last call (does not block).
+        """
+        new_events = []
+        while True:
+            try:
+                new_events.append(self.events.get_nowait())
+            except queue.Empty:
+                return new_events
@@ -2,8 +2,11 @@ import requests
 import json
 import time
 
+# host and port of the Fusion instance used by the module-level functions (see `default_client`)
 host = "localhost"
 port = 15120
+# seconds to wait for Fusion to answer a single request, so an instance that stops answering can not block forever
+request_timeout = 10.0
 
 
 class ApiError(Exception):
@@ -45,215 +48,446 @@ class ApiError(Exception):
         return self._reason
 
 
-def __make_address(endpoint):
-    return "http://{}:{}{}".format(host, port, endpoint)
+class StateTimeoutError(Exception):
+    """
+    Indicates that the protocol did not reach a state within the given time.
+    """
+
+    def __init__(self, target_state, last_state, timeout_secs):
+        self.target_state = target_state
+        self.last_state = last_state
+        self.timeout_secs = timeout_secs
+
+    def __str__(self):
+        return "<StateTimeoutError: protocol not {} after {} s, state is {}>".format(
+            self.target_state, self.timeout_secs, self.last_state)
+
+
+class FusionClient:
+    """
+    Connection to one Fusion instance (host and port), with its own HTTP session and cached protocol list.
+    Several clients can be used at the same time to control several microscopes from one computer.
+    If no host, port or request timeout is given, the module-level `host`, `port` and `request_timeout` are used.
+    A request that is not answered within the timeout raises `requests.exceptions.Timeout`.
+    """
+
+    def __init__(self, host=None, port=None, request_timeout=None):
+        self._host = host
+        self._port = port
+        self._request_timeout = request_timeout
+        self._session = requests.Session()
+        self._protocol_catalogue = None  # names of the protocols known to Fusion, filled by `get_protocol_names()`
+
+    def __repr__(self):
+        return "<FusionClient {}:{}>".format(self.host, self.port)
+
+    @property
+    def host(self):
+        return host if self._host is None else self._host
+
+    @property
+    def port(self):
+        return port if self._port is None else self._port
+
+    @property
+    def request_timeout(self):
+        return request_timeout if self._request_timeout is None else self._request_timeout
 
+    def _make_address(self, endpoint):
+        return "http://{}:{}{}".format(self.host, self.port, endpoint)
 
-def __raise_on_error(endpoint, response):
-    if (response.status_code < 200) or (response.status_code > 299):
-        raise ApiError(endpoint, response.status_code, response.reason)
+    @staticmethod
+    def _raise_on_error(endpoint, response):
+        if (response.status_code < 200) or (response.status_code > 299):
+            raise ApiError(endpoint, response.status_code, response.reason)
 
+    def _get(self, endpoint):
+        response = self._session.get(self._make_address(endpoint), timeout=self.request_timeout)
+        self._raise_on_error(endpoint, response)
+        # print("debug: received text [[%s]]" % response.text)
+        return response.json()
 
-def __get(endpoint):
-    response = requests.get(__make_address(endpoint))
-    __raise_on_error(endpoint, response)
-    # print("debug: received text [[%s]]" % response.text)
-    return response.json()
+    def _get_plain(self, endpoint):
+        response = self._session.get(self._make_address(endpoint), timeout=self.request_timeout)
+        self._raise_on_error(endpoint, response)
+        return response.text
 
+    def _get_value(self, endpoint, key):
+        struct = self._get(endpoint)
+        return struct[key]
 
-def __get_plain(endpoint):
-    response = requests.get(__make_address(endpoint))
-    __raise_on_error(endpoint, response)
-    return response.text
+    def _put(self, endpoint, obj):
+        body = json.dumps(obj)
+        self._put_plain(endpoint, body)
 
+    def _put_plain(self, endpoint, body):
+        response = self._session.put(self._make_address(endpoint), data=body, timeout=self.request_timeout)
+        self._raise_on_error(endpoint, response)
+
+    def _put_value(self, endpoint, key, value):
+        struct = {key: value}
+        self._put(endpoint, struct)
+
+    # low-level API
+
+    def _get_state(self):
+        return self._get_value("/v1/protocol/state", 'State')
+
+    def _set_state(self, value):
+        return self._put_value("/v1/protocol/state", 'State', value)
+
+    def _get_selected_protocol(self):
+        return self._get_value("/v1/protocol/current", 'Name')
+
+    def _set_selected_protocol(self, value):
+        return self._put_value("/v1/protocol/current", 'Name', value)
+
+    def _get_protocol_progress(self):
+        return self._get("/v1/protocol/progress")
+
+    def _get_protocol_list(self):
+        return self._get_value("/v1/protocol/list", 'Protocols')
+
+    # low-level API custom by Jana
+
+    def _get_current_image_path(self):
+        """This should return a string like:
+        "Path": "C:\\FusionImages\\Snap.ims"
+        """
+        return self._get_value("/v1/datasets/current", "Path")
+
+    def _get_list_of_devices(self):
+        """
+        This should return a list like "Devices": [
+                "dummy-camera",
+                "dummy-xy-stage",
+                "dummy-z-control",
+                "microscope",
+                "light-source",
+                "dummy-confocal-unit",
+                "dummy-light-source"
+                ]
+        """
+        return self._get_value("/v1/devices", "Devices")
+
+    def _get_list_of_device_features(self, device_name):
+        return self._get_plain("/v1/devices/" + device_name)
+
+    def _get_value_of_feature_of_device(self, device_name, feature_name):
+        return self._get_value("/v1/devices/" + device_name + "/" + feature_name, "Value")
+
+    def _set_value_of_feature_of_device(self, device_name, feature_name, value):
+        return self._put_value("/v1/devices/" + device_name + "/" + feature_name, "Value", value)
+
+    # high-level API
+
+    def change_protocol(self, name):
+        """
+        Changes to the protocol named.
+        """
+        self._set_selected_protocol(name)
+
+    def run(self, name):
+        """
+        Changes to the named protocol and starts to run it.
+        If no name is given, runs the currently-selected protocol.
+
+        NB: this function does not block until the state changes; use `get_state()` to be sure the protocol has
+        actually started.
+        """
+        if name is not None:
+            self._set_selected_protocol(name)
+        self._set_state('Running')
+
+    def pause(self):
+        """
+        Pauses a protocol that is currently running.
+        The protocol can be resumed with a `resume()` call.
+        It is an error to call this if no protocol is running.
+
+        NB: this function does not block until the state changes; use `get_state()` to be sure the protocol has
+        actually paused.
+        """
+        self._set_state('Paused')
+
+    def resume(self):
+        """
+        Resumes a previously-paused protocol.
+        It is an error to call this if no protocol is running or paused.
+
+        NB: this function does not block until the state changes; use `get_state()` to be sure the protocol has
+        actually resumed.
+        """
+        self._set_state('Running')
+
+    def stop(self):
+        """
+        Stops a protocol that is currently running.
+        It is an error to call this if no protocol is running or paused.
+
+        NB: this function does not block until the state changes; use `get_state()` to be sure the protocol has
+        actually stopped.
+        """
+        self._set_state('Aborted')
+
+    def get_state(self):
+        """
+        Returns the current run state of the protocol.
+        Always returns one of the following strings:
+        * Idle:     The protocol is not running.
+        * Waiting:  User requested protocol run (transitional state).
+        * Running:  Protocol is running.
+        * Paused:   Protocol was running and is now paused.
+        * Aborting: User has requested protocol stop (transitional state).
+        * Aborted:  The protocol has stopped (transitional state, will become Idle).
+        """
+        return self._get_state()
+
+    def wait_until_state(self, target_state, check_interval_secs, timeout_secs=None):
+        """
+        Waits until the protocol is in the given `target_state`.
+        Repeatedly queries the API every `check_interval_secs`.
+        This call will block until the target state is reached, or raise a `StateTimeoutError` if it was not reached
+        within `timeout_secs` (if given).
+        """
+        deadline = None if timeout_secs is None else time.time() + timeout_secs
+        state = self._get_state()
+        while state != target_state:
+            if deadline is not None and time.time() > deadline:
+                raise StateTimeoutError(target_state, state, timeout_secs)
+            time.sleep(check_interval_secs)
+            state = self._get_state()
+
+    def wait_until_idle(self, timeout_secs=None):
+        """
+        Waits until the protocol has completed, checking every 1 second.
+        This call will block until the target state is reached (or `timeout_secs` have passed, if given).
+        """
+        self.wait_until_state('Idle', 1, timeout_secs)
 
-def __get_value(endpoint, key):
-    struct = __get(endpoint)
-    return struct[key]
+    def wait_until_running(self, timeout_secs=None):
+        """
+        Waits until the protocol has started up, checking every 100 milliseconds.
+        This call will block until the target state is reached (or `timeout_secs` have passed, if given).
+        """
+        self.wait_until_state('Running', 0.1, timeout_secs)
 
+    def completion_percentage(self):
+        """
+        Returns the current protocol completion percentage, as a number ranging from 0 to 100.
+        If called after the protocol has stopped, this function will return whatever the final completion percentage
+        was. This may be less than 100 if the protocol was manually stopped early.
+        """
+        info = self._get_protocol_progress()
+        return 100 * info['Progress']
 
-def __put(endpoint, obj):
-    body = json.dumps(obj)
-    __put_plain(endpoint, body)
+    def run_protocol_completely(self, protocol_name, start_timeout_secs=None, run_timeout_secs=None):
+        """
+        Tells Fusion to run the named protocol, and waits for it to complete.
+        This call will block until the protocol has finished.
+        If the protocol does not start within `start_timeout_secs` or does not finish within `run_timeout_secs` after
+        starting, a `StateTimeoutError` is raised (no deadlines if they are None).
+        """
+        self.run(protocol_name)
+        self.wait_until_running(start_timeout_secs)
+        self.wait_until_idle(run_timeout_secs)
 
+    def get_protocol_names(self, refresh=False):
+        """
+        Returns the names of all protocols known to Fusion as a list.
+        The list is only requested once from Fusion and then cached, use `refresh=True` to request it again.
+        The endpoint is not part of Andor's examples, so besides a list of names, a list of objects with a "Name" is
+        accepted as well. Any other answer raises a ValueError.
+        """
+        if self._protocol_catalogue is None or refresh:
+            protocols = self._get_protocol_list()
+            if not isinstance(protocols, list):
+                raise ValueError("Unexpected protocol list from Fusion: {!r}".format(protocols))
+            names = []
+            for protocol in protocols:
+                if isinstance(protocol, dict) and isinstance(protocol.get("Name"), str):
+                    protocol = protocol["Name"]
+                if not isinstance(protocol, str):
+                    raise ValueError("Unexpected protocol list from Fusion: {!r}".format(protocol))
+                names.append(protocol)
+            self._protocol_catalogue = names
+        return self._protocol_catalogue
+
+    def is_known_protocol(self, name):
+        """
+        Checks if Fusion knows a protocol with this name (case sensitive).
+        If the name is not in the cached list, the list is requested again, as the protocol might have been added
+        since. Returns None if the list of protocols could not be requested from Fusion (e.g. no connection) or
+        could not be read.
+        """
+        try:
+            return name in self.get_protocol_names() or name in self.get_protocol_names(refresh=True)
+        except (ApiError, KeyError, TypeError, ValueError, requests.exceptions.RequestException):
+            return None
 
-def __put_plain(endpoint, body):
-    response = requests.put(__make_address(endpoint), data=body)
-    __raise_on_error(endpoint, response)
+    # high level API custom Jana
 
+    def get_current_image_path(self):
+        """
+        Gets the current image path and returns it to the user as a string
+        """
+        return self._get_current_image_path()
 
-def __put_value(endpoint, key, value):
-    struct = {key: value}
-    __put(endpoint, struct)
+    def get_list_of_devices(self):
+        """
+        Gets all devices as a list
+        """
+        return self._get_list_of_devices()
+
+    def get_list_of_device_features(self, device_name):
+        return self._get_list_of_device_features(device_name)
+
+    def get_value_of_feature_of_device(self, device_name, feature_name):
+        return self._get_value_of_feature_of_device(device_name, feature_name)
+
+    def set_value_of_feature_of_device(self, device_name, feature_name, feature_value):
+        return self._set_value_of_feature_of_device(device_name, feature_name, feature_value)
+
+    def for_all_devices_get_all_features(self):
+        device_list = self.get_list_of_devices()
+        print(device_list)
+        # ['andor-bob', 'light-source', 'xyz-stage', 'microscope', 'confocal-unit', 'sona-2', 'sona-1']
+        for device in device_list:
+            print(device)
+            device_features = self.get_list_of_device_features(device)
+            print("    ", device_features)
+        return
+
+    def get_protocol_progress(self):
+        progress = self._get_protocol_progress()
+        start_time = time_string_to_sensible_output(progress["StartTime"])
+        elapsed_time = time_delta_to_sensible_output(progress["ElapsedTime"])
+        remaining_time = time_delta_to_sensible_output(progress["RemainingTime"])
+        estimated_completion_time = time_string_to_sensible_output(progress["EstimatedTimeOfCompletion"])
+        progress_percentage = progress["Progress"] * 100
+        return_string = f"Started : {start_time} \n " + \
+                        f"Elapsed time: {elapsed_time} \n " + \
+                        f"Remaining time: {remaining_time} \n " + \
+                        f"Estimated completion: {estimated_completion_time} \n " + \
+                        f"Progress in %: {progress_percentage:.2f}"
+        return return_string
+
+    def get_values_of_stage(self):
+        x = self.get_value_of_feature_of_device("xyz-stage", "xposition")
+        y = self.get_value_of_feature_of_device("xyz-stage", "yposition")
+        z = self.get_value_of_feature_of_device("xyz-stage", "zposition")
+        return x, y, z
+
+    def set_values_of_stage(self, x, y, z):
+        self.set_value_of_feature_of_device("xyz-stage", "xposition", x)
+        self.set_value_of_feature_of_device("xyz-stage", "yposition", y)
+        self.set_value_of_feature_of_device("xyz-stage", "zposition", z)
+        return
+
+
+# the module-level functions below use this client, so existing scripts keep working with one Fusion instance
+default_client = FusionClient()
 
 
 # low-level API
 
 def _get_state():
-    return __get_value("/v1/protocol/state", 'State')
+    return default_client._get_state()
 
 
 def _set_state(value):
-    return __put_value("/v1/protocol/state", 'State', value)
+    return default_client._set_state(value)
 
 
 def _get_selected_protocol():
-    return __get_value("/v1/protocol/current", 'Name')
+    return default_client._get_selected_protocol()
 
 
 def _set_selected_protocol(value):
-    return __put_value("/v1/protocol/current", 'Name', value)
+    return default_client._set_selected_protocol(value)
 
 
 def _get_protocol_progress():
-    return __get("/v1/protocol/progress")
+    return default_client._get_protocol_progress()
+
+
+def _get_protocol_list():
+    return default_client._get_protocol_list()
 
 
 # low-level API custom by Jana
 
 def _get_current_image_path():
-    """This should return a string like:
-    "Path": "C:\\FusionImages\\Snap.ims"
-    """
-    return __get_value("/v1/datasets/current", "Path")
+    return default_client._get_current_image_path()
 
 
 def _get_list_of_devices():
-    """
-    This should return a list like "Devices": [
-            "dummy-camera",
-            "dummy-xy-stage",
-            "dummy-z-control",
-            "microscope",
-            "light-source",
-            "dummy-confocal-unit",
-            "dummy-light-source"
-            ]
-    """
-    return __get_value("/v1/devices", "Devices")
+    return default_client._get_list_of_devices()
 
 
 def _get_list_of_device_features(device_name):
-    return __get_plain("/v1/devices/" + device_name)
+    return default_client._get_list_of_device_features(device_name)
 
 
 def _get_value_of_feature_of_device(device_name, feature_name):
-    return __get_value("/v1/devices/" + device_name + "/" + feature_name, "Value")
+    return default_client._get_value_of_feature_of_device(device_name, feature_name)
 
 def _set_value_of_feature_of_device(device_name, feature_name, value):
-    return __put_value("/v1/devices/" + device_name + "/" + feature_name, "Value", value)
+    return default_client._set_value_of_feature_of_device(device_name, feature_name, value)
 
 
-# high-level API
+# high-level API, see the methods of `FusionClient` for details
 
 def change_protocol(name):
-    """
-    Changes to the protocol named.
-    """
-    _set_selected_protocol(name)
+    default_client.change_protocol(name)
 
 
 def run(name):
-    """
-    Changes to the named protocol and starts to run it.
-    If no name is given, runs the currently-selected protocol.
-
-    NB: this function does not block until the state changes; use `get_state()` to be sure the protocol has actually started.
-    """
-    if name is not None:
-        _set_selected_protocol(name)
-    _set_state('Running')
+    default_client.run(name)
 
 
 def pause():
-    """
-    Pauses a protocol that is currently running.
-    The protocol can be resumed with a `resume()` call.
-    It is an error to call this if no protocol is running.
-
-    NB: this function does not block until the state changes; use `get_state()` to be sure the protocol has actually paused.
-    """
-    _set_state('Paused')
+    default_client.pause()
 
 
 def resume():
-    """
-    Resumes a previously-paused protocol.
-    It is an error to call this if no protocol is running or paused.
-
-    NB: this function does not block until the state changes; use `get_state()` to be sure the protocol has actually resumed.
-    """
-    _set_state('Running')
+    default_client.resume()
 
 
 def stop():
-    """
-    Stops a protocol that is currently running.
-    It is an error to call this if no protocol is running or paused.
-
-    NB: this function does not block until the state changes; use `get_state()` to be sure the protocol has actually stopped.
-    """
-    _set_state('Aborted')
+    default_client.stop()
 
 
 def get_state():
-    """
-    Returns the current run state of the protocol.
-    Always returns one of the following strings:
-    * Idle:     The protocol is not running.
-    * Waiting:  User requested protocol run (transitional state).
-    * Running:  Protocol is running.
-    * Paused:   Protocol was running and is now paused.
-    * Aborting: User has requested protocol stop (transitional state).
-    * Aborted:  The protocol has stopped (transitional state, will become Idle).
-    """
-    return _get_state()
+    return default_client.get_state()
 
 
-def wait_until_state(target_state, check_interval_secs):
-    """
-    Waits until the protocol is in the given `target_state`.
-    Repeatedly queries the API every `check_interval_secs`.
-    This call will block until the target state is reached.
-    """
-    while _get_state() != target_state:
-        time.sleep(check_interval_secs)
+def wait_until_state(target_state, check_interval_secs, timeout_secs=None):
+    default_client.wait_until_state(target_state, check_interval_secs, timeout_secs)
 
 
-def wait_until_idle():
-    """
-    Waits until the protocol has completed, checking every 1 second.
-    This call will block until the target state is reached.
-    """
-    wait_until_state('Idle', 1)
+def wait_until_idle(timeout_secs=None):
+    default_client.wait_until_idle(timeout_secs)
 
 
-def wait_until_running():
-    """
-    Waits until the protocol has started up, checking every 100 milliseconds.
-    This call will block until the target state is reached.
-    """
-    wait_until_state('Running', 0.1)
+def wait_until_running(timeout_secs=None):
+    default_client.wait_until_running(timeout_secs)
 
 
 def completion_percentage():
-    """
-    Returns the current protocol completion percentage, as a number ranging from 0 to 100.
-    If called after the protocol has stopped, this function will return whatever the final completion percentage was.
-    This may be less than 100 if the protocol was manually stopped early.
-    """
-    info = _get_protocol_progress()
-    return 100 * info['Progress']
+    return default_client.completion_percentage()
 
 
-def run_protocol_completely(protocol_name):
-    """
-    Tells Fusion to run the named protocol, and waits for it to complete.
-    This call will block until the protocol has finished.
-    """
-    run(protocol_name)
-    wait_until_running()
-    wait_until_idle()
+def run_protocol_completely(protocol_name, start_timeout_secs=None, run_timeout_secs=None):
+    default_client.run_protocol_completely(protocol_name, start_timeout_secs, run_timeout_secs)
+
+
+def get_protocol_names(refresh=False):
+    return default_client.get_protocol_names(refresh)
+
+
+def is_known_protocol(name):
+    return default_client.is_known_protocol(name)
 
 
 # high level API custom Jana
@@ -261,36 +495,29 @@ def get_current_image_path():
     """
     Gets the current image path and returns it to the user as a string
     """
-    return _get_current_image_path()
+    return default_client.get_current_image_path()
 
 
 def get_list_of_devices():
     """
     Gets all devices as a list
     """
-    return _get_list_of_devices()
+    return default_client.get_list_of_devices()
 
 
 def get_list_of_device_features(device_name):
-    return _get_list_of_device_features(device_name)
+    return default_client.get_list_of_device_features(device_name)
 
 
 def get_value_of_feature_of_device(device_name, feature_name):
-    return _get_value_of_feature_of_device(device_name, feature_name)
-    
+    return default_client.get_value_of_feature_of_device(device_name, feature_name)
+
 def set_value_of_feature_of_device(device_name, feature_name, feature_value):
-    return _set_value_of_feature_of_device(device_name, feature_name, feature_value)
+    return default_client.set_value_of_feature_of_device(device_name, feature_name, feature_value)
 
 
 def for_all_devices_get_all_features():
-    device_list = get_list_of_devices()
-    print(device_list)
-    # ['andor-bob', 'light-source', 'xyz-stage', 'microscope', 'confocal-unit', 'sona-2', 'sona-1']
-    for device in device_list:
-        print(device)
-        device_features = get_list_of_device_features(device)
-        print("    ", device_features)
-    return
+    default_client.for_all_devices_get_all_features()
 
 def time_string_to_sensible_output(time_string):
     from dateutil.parser import isoparse
@@ -311,31 +538,15 @@ def time_delta_to_sensible_output(time_string):
 
 
 def get_protocol_progress():
-    progress = _get_protocol_progress()
-    start_time = time_string_to_sensible_output(progress["StartTime"])
-    elapsed_time = time_delta_to_sensible_output(progress["ElapsedTime"])
-    remaining_time = time_delta_to_sensible_output(progress["RemainingTime"])
-    estimated_completion_time = time_string_to_sensible_output(progress["EstimatedTimeOfCompletion"])
-    progress_percentage = progress["Progress"] * 100
-    return_string = f"Started : {start_time} \n " + \
-                    f"Elapsed time: {elapsed_time} \n " + \
-                    f"Remaining time: {remaining_time} \n " + \
-                    f"Estimated completion: {estimated_completion_time} \n " + \
-                    f"Progress in %: {progress_percentage:.2f}"
-    return return_string
+    return default_client.get_protocol_progress()
 
 
 def get_values_of_stage():
-    x = get_value_of_feature_of_device("xyz-stage", "xposition")
-    y = get_value_of_feature_of_device("xyz-stage", "yposition")
-    z = get_value_of_feature_of_device("xyz-stage", "zposition")
-    return x, y, z
-    
+    return default_client.get_values_of_stage()
+
 def set_values_of_stage(x, y, z):
-    set_value_of_feature_of_device("xyz-stage", "xposition", x)
-    set_value_of_feature_of_device("xyz-stage", "yposition", y)
-    set_value_of_feature_of_device("xyz-stage", "zposition", z)
-    return 
+    default_client.set_values_of_stage(x, y, z)
+    return
 
 def get_exposure_time():
     get_value_of_feature_of_device("exposuretime")
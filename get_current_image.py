@@ -1,18 +1,190 @@
 from fusionrest import get_current_image_path
+import image_cache
 import os
+import zlib
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 import h5py
 import numpy as np
 import matplotlib.pyplot as plt
 
+projection_block_bytes = 64 * 1024 ** 2  # size of the blocks of z-planes read at once by `imaris_projection`
+
+
+def _read_imaris_attribute(group, name):
+    # imaris stores attributes as arrays of single characters, e.g. [b'5', b'1', b'2']
+    return b"".join(group.attrs[name]).decode()
+
+
+def _bounds_to_slice(bounds, size):
+    # turn (start, stop) pixel bounds into a slice that is clipped to the data set
+    start, stop = sorted(int(round(b)) for b in bounds)
+    return slice(min(max(start, 0), size), min(max(stop, 0), size))
+
+
+def roi_to_slices(h5file, roi, data_shape):
+    """
+
+    Convert a region of interest into slices of an imaris data set (order on disk: z, y, x).
+
+    * pixel: bounds are given in pixels of the highest resolution level
+    * stage: bounds are given in the units of the image extents (usually um), converted using the
+      ExtMin/ExtMax values imaris stores in DataSetInfo/Image
+
+    :param h5file: h5py.File, opened .ims file
+    :param roi: dict, e.g. {"units": "pixel", "x": (0, 100), "y": (50, 150)}, "z" is optional
+    :param data_shape: tuple, shape of the data set that is read, (z, y, x)
+    :return: tuple of slices, (z, y, x)
+    :raises ValueError: if the roi does not contain any pixel of the image
 
-def imaris_image_reader(file):
+    """
+    units = roi.get("units", "pixel")
+    slices = []
+    for axis, dim, size in (("z", 2, data_shape[0]), ("y", 1, data_shape[1]), ("x", 0, data_shape[2])):
+        bounds = roi.get(axis)
+        if bounds is None:
+            slices.append(slice(0, size))
+            continue
+        if units == "stage":
+            info = h5file['DataSetInfo']['Image']
+            ext_min = float(_read_imaris_attribute(info, f"ExtMin{dim}"))
+            ext_max = float(_read_imaris_attribute(info, f"ExtMax{dim}"))
+            n_pixels = int(_read_imaris_attribute(info, "XYZ"[dim]))
+            pixel_size = (ext_max - ext_min) / n_pixels
+            bounds = [(b - ext_min) / pixel_size for b in bounds]
+        elif units != "pixel":
+            raise ValueError(f"Unknown roi units: {units}")
+        selection = _bounds_to_slice(bounds, size)
+        if selection.start >= selection.stop:
+            raise ValueError(f"The roi {roi[axis]} in {axis} ({units}) does not overlap with the image "
+                             f"(size {size} pixels)")
+        slices.append(selection)
+    return tuple(slices)
+
+
+def _chunk_overlap(chunk_offset, chunk_shape, selection):
+    # for each axis, get the part of the chunk that lies within the selection, relative to the chunk and to the output
+    chunk_slices, out_slices = [], []
+    for offset, size, sel in zip(chunk_offset, chunk_shape, selection):
+        start, stop = max(offset, sel.start), min(offset + size, sel.stop)
+        if start >= stop:
+            return None
+        chunk_slices.append(slice(start - offset, stop - offset))
+        out_slices.append(slice(start - sel.start, stop - sel.start))
+    return tuple(chunk_slices), tuple(out_slices)
+
+
+def _selected_chunk_offsets(chunk_shape, selection):
+    # offsets of the chunk grid that overlap the selection, without looking up the stored chunks in the file
+    ranges = [range(sel.start - sel.start % size, sel.stop, size) for size, sel in zip(chunk_shape, selection)]
+    return list(itertools.product(*ranges))
+
+
+def read_chunks_in_parallel(data, selection=None, workers=None):
+    """
+
+    Read a gzip compressed h5py data set by decompressing its chunks on a thread pool.
+
+    The raw chunks are fetched with direct chunk reads, inflated with zlib (which releases the GIL, so the threads
+    really run in parallel) and copied into a preallocated array. Only chunks overlapping the selection are read.
+
+    :param data: h5py.Dataset, chunked and only compressed with gzip
+    :param selection: tuple of slices or None, part of the data set to read (whole data set if None)
+    :param workers: int or None, number of threads, defaults to the number of cores
+    :return: np.array or None, image data, None if the data set can not be read this way (e.g. other filters) or
+        only one thread would be used
+
+    """
+    plist = data.id.get_create_plist()
+    if data.chunks is None or plist.get_nfilters() != 1 or plist.get_filter(0)[0] != h5py.h5z.FILTER_DEFLATE:
+        return None
+    workers = workers or os.cpu_count() or 1
+    if workers < 2:
+        # with a single thread this is not faster than h5py's own reading
+        return None
+    if not hasattr(data.id, "get_chunk_info_by_coord"):
+        # direct chunk access needs h5py >= 3.0 built against HDF5 >= 1.10.5
+        return None
+    if selection is None:
+        selection = tuple(slice(0, size) for size in data.shape)
+    # only the chunks overlapping the selection, listing all stored chunks would take long for large files
+    chunk_offsets = _selected_chunk_offsets(data.chunks, selection)
+
+    img = np.full(tuple(sel.stop - sel.start for sel in selection), data.fillvalue, dtype=data.dtype)
+
+    def read_chunk(chunk_offset):
+        overlap = _chunk_overlap(chunk_offset, data.chunks, selection)
+        if overlap is None:
+            return
+        try:
+            filter_mask, raw = data.id.read_direct_chunk(chunk_offset)
+        except RuntimeError:
+            # chunks that were never written are not stored, they keep the fill value
+            if data.id.get_chunk_info_by_coord(chunk_offset).byte_offset is None:
+                return
+            raise
+        # a set bit in the filter mask means the filter was skipped for this chunk, i.e. it is stored uncompressed
+        if not filter_mask & 1:
+            raw = zlib.decompress(raw)
+        chunk = np.frombuffer(raw, dtype=data.dtype).reshape(data.chunks)
+        chunk_slices, out_slices = overlap
+        img[out_slices] = chunk[chunk_slices]
+
+    def read_batch(batch):
+        for chunk_offset in batch:
+            read_chunk(chunk_offset)
+
+    # a few batches of chunks per thread instead of one task per chunk, so small chunks don't add much overhead
+    n_batches = min(len(chunk_offsets), 4 * workers)
+    batches = [chunk_offsets[i::n_batches] for i in range(n_batches)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() to raise any exception that happened in one of the threads
+        list(executor.map(read_batch, batches))
+    return img
+
+
+def _scale_slices(slices, from_shape, to_shape):
+    # convert slices of one resolution level into slices of another resolution level
+    scaled = []
+    for sel, from_size, to_size in zip(slices, from_shape, to_shape):
+        start = sel.start * to_size // from_size
+        stop = min(-(-sel.stop * to_size // from_size), to_size)
+        scaled.append(slice(start, max(start, stop)))
+    return tuple(scaled)
+
+
+def _imaris_data(h5file, channel, resolution_level):
+    # data set of the first time point, shape: (z, y, x)
+    return h5file['DataSet'][f'ResolutionLevel {resolution_level}']['TimePoint 0'][f'Channel {channel}']['Data']
+
+
+def _imaris_selection(h5file, data, roi, channel):
+    # slices of the data set for a roi given in the highest resolution (None for the whole data set)
+    if roi is None:
+        return None
+    full_shape = _imaris_data(h5file, channel, 0).shape
+    return _scale_slices(roi_to_slices(h5file, roi, full_shape), full_shape, data.shape)
+
+
+def imaris_image_reader(file, roi=None, parallel=True, channel=0, resolution_level=0):
     """
 
     Read a 3D imaris image as a numpy array.
 
-    * .ims: imaris file using h5py, highest resolution and first time point is loaded
+    * .ims: imaris file using h5py, first time point is loaded (by default the first channel in highest resolution)
+
+    If a region of interest is given, only this part of the image is read. h5py then only fetches and
+    decompresses the chunks that overlap with the roi.
+
+    By default gzip compressed chunks are decompressed in parallel (see `read_chunks_in_parallel`), for other
+    compression filters the normal (single-threaded) h5py reading is used.
 
     :param file: str, path to image file, can be relative or absolute.
+    :param roi: dict or None, region of interest, see `roi_to_slices`
+    :param parallel: bool, decompress chunks on several threads if possible
+    :param channel: int, channel to load
+    :param resolution_level: int, resolution level to load (0 is the highest resolution), the roi is always given
+        for the highest resolution
     :return: np.array, image data, shape: (x, y, (z))
 
     """
@@ -21,7 +193,12 @@ def imaris_image_reader(file):
 
     if file_extension == '.ims':
 
-        img = h5py.File(file, 'r')['DataSet']['ResolutionLevel 0']['TimePoint 0']['Channel 0']['Data'][()]
+        with h5py.File(file, 'r') as h5file:
+            data = _imaris_data(h5file, channel, resolution_level)
+            selection = _imaris_selection(h5file, data, roi, channel)
+            img = read_chunks_in_parallel(data, selection) if parallel else None
+            if img is None:
+                img = data[()] if selection is None else data[selection]
 
     else:
         raise TypeError("File is not an .ims file")
@@ -32,14 +209,92 @@ def imaris_image_reader(file):
     return img
 
 
-def get_current_image_3d():
-    print("Loading image", get_current_image_path())
-    im = imaris_image_reader(get_current_image_path())
+def _reduce_block(block, method, axis):
+    # sums (also for means) are accumulated in a larger data type, so they do not overflow
+    if method == "max":
+        return np.max(block, axis=axis)
+    return np.sum(block, axis=axis, dtype=np.float64 if method == "mean" else None)
+
+
+def imaris_projection(file, method="max", axis=2, roi=None, parallel=True, channel=0, resolution_level=0):
+    """
+
+    Project a 3D imaris image along one axis, without reading the whole image into memory.
+
+    The image is read in blocks of z-planes (whole chunks, in the order they are stored in the file) and every block
+    is reduced right after it is read. Projecting along z reduces along the first axis of the data set, so this walks
+    through contiguous memory, and only the small 2D result is transposed to the axis order of `imaris_image_reader`.
+    The result is the same as e.g. `np.max(imaris_image_reader(file), axis=2)`.
+
+    :param file: str, path to image file, can be relative or absolute.
+    :param method: str, "max", "mean" or "sum"
+    :param axis: int, axis to project along, in the axis order of `imaris_image_reader` (0: x, 1: y, 2: z)
+    :param roi: dict or None, region of interest, see `roi_to_slices`
+    :param parallel: bool, decompress chunks on several threads if possible
+    :param channel: int, channel to load
+    :param resolution_level: int, resolution level to load (0 is the highest resolution)
+    :return: np.array, projection, shape: (x, y) for axis 2, (y, z) for axis 0 and (x, z) for axis 1. Means are
+        float64, sums have the data type np.sum would give.
+
+    """
+    if method not in ("max", "mean", "sum"):
+        raise ValueError(f"Unknown projection method: {method}")
+    if os.path.splitext(file)[1] != '.ims':
+        raise TypeError("File is not an .ims file")
+    disk_axis = 2 - axis  # the data set is stored as (z, y, x)
+
+    with h5py.File(file, 'r') as h5file:
+        data = _imaris_data(h5file, channel, resolution_level)
+        selection = _imaris_selection(h5file, data, roi, channel)
+        if selection is None:
+            selection = tuple(slice(0, size) for size in data.shape)
+        z_start, z_stop = selection[0].start, selection[0].stop
+        # blocks of about projection_block_bytes, made of whole chunks, so every chunk is only decompressed once
+        chunk_depth = data.chunks[0] if data.chunks else 1
+        plane_bytes = (selection[1].stop - selection[1].start) * (selection[2].stop - selection[2].start) \
+            * data.dtype.itemsize
+        block_depth = max(1, projection_block_bytes // max(plane_bytes * chunk_depth, 1)) * chunk_depth
+
+        projection, parts = None, []
+        for block_start in range(z_start - z_start % chunk_depth, z_stop, block_depth):
+            block_selection = (slice(max(block_start, z_start), min(block_start + block_depth, z_stop)),) \
+                + selection[1:]
+            # only the chunks overlapping this block are read
+            block = read_chunks_in_parallel(data, block_selection) if parallel else None
+            if block is None:
+                block = data[block_selection]
+            reduced = _reduce_block(block, method, disk_axis)
+            if disk_axis != 0:
+                # each block gives some rows of the projection
+                parts.append(reduced)
+            elif projection is None:
+                projection = reduced
+            elif method == "max":
+                np.maximum(projection, reduced, out=projection)
+            else:
+                projection += reduced
+        if disk_axis != 0:
+            projection = np.concatenate(parts, axis=0)
+
+    if method == "mean":
+        projection /= selection[disk_axis].stop - selection[disk_axis].start
+    return projection.T
+
+
+def get_current_image_3d(roi=None, path=None):
+    # if a path is given (e.g. the current image of another microscope), that image is used instead
+    path = get_current_image_path() if path is None else path
+    print("Loading image", path)
+    im = imaris_image_reader(path, roi=roi)
     return im
 
 
-def get_current_image_2d():
-    return np.max(get_current_image_3d(), axis=2)
+def get_current_image_2d(roi=None, path=None):
+    # the z-projection of the whole image is cached, so it does not need to be calculated again for the same image
+    path = get_current_image_path() if path is None else path
+    if roi is not None:
+        return imaris_projection(path, roi=roi)
+    return image_cache.get_projection(path, lambda: imaris_projection(path))
 
 
 def show_projection_of_current_image():
@@ -0,0 +1,191 @@
+"""
+On-disk cache for results calculated from images (z-projection, thumbnail and trigger statistics).
+
+Every image gets one uncompressed .npz file (z-projection and thumbnail) and one small .json file (statistics) in the
+cache folder, so looking up a statistic does not read the projection. The file names are a hash of the image path,
+its modification time and its size, so a changed image automatically gets a new cache entry. If the cache folder gets
+larger than `max_cache_size_bytes`, the least recently used entries are deleted.
+"""
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+
+cache_dir = os.path.join(os.path.expanduser("~"), ".dragonfly_looper_cache")
+max_cache_size_bytes = 500 * 1024 ** 2
+thumbnail_size = 128
+enabled = True
+
+_lock = threading.Lock()
+
+
+def cache_key(file):
+    """
+    Gives the key of the cache entry of an image, based on the absolute path, the modification time and the size.
+    """
+    stat = os.stat(file)
+    text = f"{os.path.abspath(file)}|{stat.st_mtime_ns}|{stat.st_size}"
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def _entry_path(file, extension=".npz"):
+    return os.path.join(cache_dir, cache_key(file) + extension)
+
+
+def _load_arrays(file):
+    # projection and thumbnail of an image
+    path = _entry_path(file)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with np.load(path) as npz:
+            # older entries also contained the statistics, they are stored separately now
+            arrays = {name: npz[name] for name in npz.files if name != "statistics"}
+        # mark the entry as recently used for the eviction
+        os.utime(path)
+    except (OSError, ValueError):
+        # unreadable (e.g. partially written) entries, and entries evicted meanwhile by another thread or process,
+        # are treated as not cached
+        return {}
+    return arrays
+
+
+def _load_statistics(file):
+    # statistics are stored in a small json file, so looking one up does not read the projection
+    path = _entry_path(file, ".json")
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            statistics = json.load(f)
+        os.utime(path)
+    except (OSError, ValueError):
+        # see `_load_arrays`
+        return {}
+    return statistics
+
+
+def load_entry(file):
+    """
+    Loads everything that is cached for an image as a dictionary (empty if nothing is cached).
+    """
+    if not enabled:
+        return {}
+    entry = _load_arrays(file)
+    statistics = _load_statistics(file)
+    if statistics:
+        entry["statistics"] = statistics
+    return entry
+
+
+def _save(path, write):
+    # write to a temporary file first, so other readers never see half written entries
+    os.makedirs(cache_dir, exist_ok=True)
+    temporary_path = path + f".{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary_path, "wb") as f:
+        write(f)
+    os.replace(temporary_path, path)
+    evict()
+
+
+def _save_arrays(file, arrays):
+    _save(_entry_path(file), lambda f: np.savez(f, **arrays))
+
+
+def _save_statistics(file, statistics):
+    _save(_entry_path(file, ".json"), lambda f: f.write(json.dumps(statistics).encode()))
+
+
+def evict(max_size=None):
+    """
+    Deletes the least recently used cache entries until the cache is smaller than `max_size` bytes
+    (by default `max_cache_size_bytes`).
+    """
+    max_size = max_cache_size_bytes if max_size is None else max_size
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith((".npz", ".json")):
+            try:
+                stat = os.stat(os.path.join(cache_dir, name))
+            except FileNotFoundError:
+                continue  # evicted by another thread or process meanwhile
+            entries.append((stat.st_mtime, stat.st_size, name))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            pass  # evicted by another thread or process meanwhile
+        total_size -= size
+
+
+def make_thumbnail(projection):
+    """
+    Downsamples a 2D image so that its longest side has at most `thumbnail_size` pixels. Each pixel of the thumbnail
+    is the maximum of a block of pixels, so small bright features stay visible.
+    """
+    step = max(1, int(np.ceil(max(projection.shape) / thumbnail_size)))
+    if step == 1:
+        return np.ascontiguousarray(projection)
+    # repeat the edge pixels to get whole blocks, this does not change the maxima
+    padding = [(0, -size % step) for size in projection.shape]
+    padded = np.pad(projection, padding, mode="edge")
+    blocks = padded.reshape(padded.shape[0] // step, step, padded.shape[1] // step, step)
+    return blocks.max(axis=(1, 3))
+
+
+def get_projection(file, calculate_projection):
+    """
+    Returns the cached z-projection of an image. If it is not cached yet, it is calculated using
+    `calculate_projection()` and stored together with a thumbnail.
+    """
+    if not enabled:
+        return calculate_projection()
+    arrays = _load_arrays(file)
+    if "projection" in arrays:
+        return arrays["projection"]
+    projection = calculate_projection()
+    with _lock:
+        _save_arrays(file, {"projection": projection, "thumbnail": make_thumbnail(projection)})
+    return projection
+
+
+def get_thumbnail(file):
+    """
+    Returns the cached thumbnail of an image, or None if no projection was calculated for this image yet.
+    """
+    if not enabled:
+        return None
+    return _load_arrays(file).get("thumbnail")
+
+
+def get_statistics(file):
+    """
+    Returns all cached statistics of an image as a dictionary {name: value}.
+    """
+    if not enabled:
+        return {}
+    return _load_statistics(file)
+
+
+def get_statistic(file, name, calculate_statistic):
+    """
+    Returns a cached statistic (e.g. the value of a trigger function) of an image. If it is not cached yet, it is
+    calculated using `calculate_statistic()` and stored.
+    """
+    if not enabled:
+        return calculate_statistic()
+    statistics = get_statistics(file)
+    if name in statistics:
+        return statistics[name]
+    value = float(calculate_statistic())
+    with _lock:
+        statistics = _load_statistics(file)
+        statistics[name] = value
+        _save_statistics(file, statistics)
+    return value
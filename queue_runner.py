@@ -0,0 +1,401 @@
+"""
+Runs the queue set up in the GUI on one microscope, independent of the GUI itself.
+"""
+import time
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor, Future
+from requests.adapters import ConnectionError
+from requests.exceptions import Timeout
+import fusionrest  # import functionality provided by Andor (and expanded for loading the last image)
+from get_current_image import get_current_image_2d  # import image loader functions
+import trigger_registry  # trigger functions and the data they need
+import run_history  # recording of protocol durations and trigger results
+
+
+class PrintColors:
+    # for printing_in_colors
+    # from https://stackoverflow.com/questions/287871/how-do-i-print-colored-text-to-the-terminal 20th May 2025
+    HEADER = '\033[95m'
+    OKBLUE = '\033[94m'
+    OKCYAN = '\033[96m'
+    OKGREEN = '\033[92m'
+    WARNING = '\033[93m'
+    FAIL = '\033[91m'
+    ENDC = '\033[0m'
+    BOLD = '\033[1m'
+    UNDERLINE = '\033[4m'
+
+
+class QueueRunner:
+    """
+    Runs a queue (protocols, waits, nested loops and if-statements) on the microscope controlled by one Fusion client.
+    Runners with different clients are independent, so several microscopes can run their queues at the same time.
+
+    The queue is a list of dictionaries as set up in the GUI. Function items describe what to do with their action:
+    ("protocol", name), ("wait", seconds), ("progress",) or ("z_projection",).
+    """
+    def __init__(self, client, queue, repeat_count=1, main_interval=0.0, start_timeout=60.0, run_timeout=0.0,
+                 failure_policy="skip", retries=1, on_projection=None, name=None, on_event=None):
+        self.client = client
+        self.queue = queue
+        self.repeat_count = repeat_count
+        self.main_interval = main_interval
+        # deadlines for protocols (0 means no deadline) and what to do if a protocol fails
+        self.start_timeout = start_timeout
+        self.run_timeout = run_timeout
+        self.failure_policy = failure_policy
+        self.retries = retries
+        # called with every z-projection that is shown, e.g. to display it in the GUI
+        self.on_projection = on_projection
+        # called with a dictionary for every step, trigger result and at the end, e.g. to stream them to the GUI
+        self.on_event = on_event
+        self.name = name
+        # with several microscopes, every printed line starts with the name of the microscope
+        self.prefix = f"[{name}] " if name else ""
+
+        self.start_time_global = time.time()  # set a start time, it will be overwritten when the main loop is started
+        self.running = False
+        self.resumed = threading.Event()  # cleared while the queue is paused
+        self.resumed.set()
+        self.current_nesting = 0
+        self.thread = None
+        # data of the last analyzed image, shared by all triggers evaluated on it
+        self.image_data = None
+        self.image_data_lock = threading.Lock()
+
+    def indent(self, depth):
+        return self.prefix + "  " * depth
+
+    def start(self):
+        # start running the main loop in a background thread
+        self.running = True
+        self.start_time_global = time.time()
+        self.thread = threading.Thread(target=self.run_main_loop, daemon=True)
+        self.thread.start()
+
+    def emit(self, event_type, **data):
+        if self.on_event:
+            self.on_event(dict(type=event_type, runner=self.name, **data))
+
+    def pause(self):
+        # pause the queue after the current step (a protocol that is running is finished first)
+        self.resumed.clear()
+        print(self.prefix + f"{PrintColors.WARNING}Pausing after the current step.{PrintColors.ENDC}")
+
+    def resume(self):
+        self.resumed.set()
+
+    def stop(self):
+        # stop the main loop after the current step and also stop the microscope
+        self.running = False
+        self.resumed.set()
+        try:
+            self.client.stop()
+        except (fusionrest.ApiError, ConnectionError, Timeout):
+            # no protocol is running (or no connection)
+            pass
+
+    def run_main_loop(self):
+        # run the main loop: get the start time for each loop interval, run the complete queue, wait if necessary
+        try:
+            for _ in range(self.repeat_count):
+                if not self.running:
+                    break
+                start_time = time.time()
+                self.run_queue(self.queue)
+                elapsed = time.time() - start_time
+                wait_time = max(0, self.main_interval - elapsed)
+                if self.running and wait_time > 0:
+                    print(self.prefix + f"Waiting {wait_time:.2f} seconds to maintain main loop interval.")
+                    time.sleep(wait_time)
+        except Exception as e:
+            # an unexpected error ends the loop, but the runner still finishes, so a new loop can be started
+            print(self.prefix + f"{PrintColors.FAIL}Main loop stopped by an error: {e}{PrintColors.ENDC}")
+        finally:
+            self.running = False
+        print(self.prefix + f"{PrintColors.OKGREEN}Main loop completed or stopped.{PrintColors.ENDC}")
+        print(self.prefix + f"{PrintColors.OKGREEN}Running everything took "
+              + str(round(time.time() - self.start_time_global, 1))
+              + f" seconds{PrintColors.ENDC}")
+        self.emit("finished", seconds=time.time() - self.start_time_global)
+
+    def get_image_data(self, path):
+        # triggers evaluated on the same image share the data loaded for it
+        with self.image_data_lock:
+            if path is None:
+                return trigger_registry.ImageData(None)
+            if self.image_data is None or not self.image_data.is_current(path):
+                self.image_data = trigger_registry.ImageData(path)
+            return self.image_data
+
+    def uses_default_instance(self):
+        # plain trigger functions without a path argument always analyze the image of the default Fusion instance
+        default = fusionrest.default_client
+        return self.client is default or (self.client.host, self.client.port) == (default.host, default.port)
+
+    def check_trigger(self, func_name, condition, threshold, roi=None, path=None):
+        # check if the trigger condition was met, if yes return true
+        # if a roi is given, it is handed to the trigger function, so only this region of the image is read
+        # the trigger function gets the image of this runner's microscope (if it accepts a path), for
+        # pipelined triggers this is the image of the iteration that is analyzed
+        try:
+            if not trigger_registry.accepts_path(func_name) and not self.uses_default_instance():
+                # the function would load the current image of the default instance, i.e. of another microscope
+                print(self.prefix + f"{PrintColors.FAIL}Trigger function {func_name} can only analyze the image of "
+                      f"{fusionrest.default_client.host}:{fusionrest.default_client.port}, please register it or "
+                      f"give it a path argument. The trigger is not checked.{PrintColors.ENDC}")
+                return False
+            if path is None and trigger_registry.accepts_path(func_name):
+                path = self.client.get_current_image_path()
+            start_time = time.time()
+            value = trigger_registry.evaluate(func_name, self.get_image_data(path), roi)
+            met = (condition == '<' and value < threshold) or (condition == '>' and value > threshold)
+            run_history.record_trigger_result(func_name, condition, threshold, met, start_time,
+                                              time.time() - start_time)
+            self.emit("trigger", function=func_name, value=float(value), met=bool(met))
+            if met:
+                print(self.indent(self.current_nesting) +
+                      f"{PrintColors.OKCYAN}TRIGGER MET: {value:.2f} {condition} {threshold}{PrintColors.ENDC}")
+                return True
+            else:
+                print(self.indent(self.current_nesting)
+                      + f"Trigger not met, trigger function {func_name} returned value: {value:.2f}")
+            return False
+        except Exception as e:
+            print(self.prefix
+                  + f"{PrintColors.FAIL}Error executing trigger function {func_name}: {e}{PrintColors.ENDC}")
+            return False
+
+    def submit_pipelined_trigger(self, executor, loop_trigger):
+        # start analyzing the image that was just acquired on the worker thread, the path is read now, as the
+        # current image changes as soon as the next iteration acquires
+        try:
+            path = self.client.get_current_image_path()
+        except (ConnectionError, Timeout, fusionrest.ApiError):
+            # without the path, the worker would analyze whatever image is current later on, i.e. possibly the next
+            # iteration's image while it is still written, so this check counts as failed
+            print(self.prefix + f"{PrintColors.FAIL}Could not get the image path from the microscope, trigger "
+                  f"{loop_trigger['function']} is not checked for this iteration.{PrintColors.ENDC}")
+            failed_check = Future()
+            failed_check.set_result(False)
+            return failed_check
+        return executor.submit(self.check_trigger, loop_trigger['function'], loop_trigger['condition'],
+                               loop_trigger['threshold'], loop_trigger.get('roi'), path)
+
+    @staticmethod
+    def pipelined_trigger_met(pending, lag):
+        # collect all finished analyses, and wait for the oldest ones if more than `lag` iterations are not analyzed
+        met = False
+        while pending and (pending[0].done() or len(pending) > lag):
+            met = pending.popleft().result() or met
+        return met
+
+    def execute(self, item):
+        # execute a function item of the queue
+        action = item.get('action')
+        if action is None:
+            item['value']()
+        elif action[0] == 'protocol':
+            self.set_protocol(action[1])
+        elif action[0] == 'wait':
+            self.wait(action[1])
+        elif action[0] == 'progress':
+            self.get_progress()
+        elif action[0] == 'z_projection':
+            self.show_z_projection()
+
+    def run_queue(self, queue, depth=0):
+        # run the queue that was set up
+        index = 0
+        # if the index has not reached the queue length, execute the next item in the queue
+        while index < len(queue):
+            # wait here while the queue is paused
+            self.resumed.wait()
+            if not self.running:
+                break
+
+            # get the next item in the queue
+            item = queue[index]
+
+            # if the next item type is a function, execute it
+            if item['type'] == 'func':
+                self.current_nesting = depth
+                label = item.get('label') or item['value'].__name__
+                print(self.indent(depth) + f"{PrintColors.BOLD}Executing: {label}{PrintColors.ENDC}, "
+                      + f"start time: {time.strftime('%a %H:%M:%S')}")
+                self.emit("step", label=label, depth=depth)
+                self.execute(item)
+
+
+            elif item['type'] == 'loop_start':
+                if item['value'].get('is_conditional'):
+                    loop_info = item['value']
+                    loop_body = []
+                    nest = 1
+                    index += 1
+                    while index < len(queue) and nest > 0:
+                        if queue[index]['type'] == 'loop_start':
+                            nest += 1
+                        elif queue[index]['type'] == 'loop_end':
+                            nest -= 1
+                        if nest > 0:
+                            loop_body.append(queue[index])
+                        index += 1
+                    trigger = loop_info.get('trigger', {})
+
+                    should_run = self.check_trigger(
+                        trigger.get('function_name'),
+                        trigger.get('condition'),
+                        trigger.get('threshold'),
+                        trigger.get('roi')
+                    )
+
+                    if should_run:
+                        self.run_queue(loop_body, depth + 1)
+
+                    continue
+
+                else:
+
+                    # get loop count, interval, trigger [if any] and "nesting level"
+                    loop_count = item['value'].get('count', 1)
+                    loop_interval = item['value'].get('interval', 0)
+                    loop_trigger = item['value'].get('trigger', None)
+                    inner_queue = []
+                    nest = 1
+                    index += 1
+
+                    # go to the next nesting level of the new loop
+                    while index < len(queue) and nest > 0:
+                        if queue[index]['type'] == 'loop_start':
+                            nest += 1
+                        elif queue[index]['type'] == 'loop_end':
+                            nest -= 1
+                        # if the loop is nested, add it to the list of inner queue
+                        if nest > 0:
+                            inner_queue.append(queue[index])
+                        # increase the index as this item of the queue is handled (have to increase it here, as the
+                        # inner loop uses continue, so it's not increased otherwise if there is an inner loop started
+                        index += 1
+
+                    # pipelined triggers are analyzed on a worker thread while the next iteration already runs, this
+                    # only works for trigger functions that can analyze a given image (path argument)
+                    pipelined = (loop_trigger and loop_trigger.get('pipelined')
+                                 and trigger_registry.accepts_path(loop_trigger['function']))
+                    executor = ThreadPoolExecutor(max_workers=1) if pipelined else None
+                    pending = collections.deque()
+
+                    try:
+                        # start the inner loop
+                        for _ in range(loop_count):
+                            # get the start time to keep track of time
+                            start_time = time.time()
+                            # run the inner queue (this is a recursive function call)
+                            self.run_queue(inner_queue, depth + 1)
+
+                            # check if the trigger condition was met (for pipelined triggers: for any finished
+                            # analysis)
+                            if pipelined:
+                                pending.append(self.submit_pipelined_trigger(executor, loop_trigger))
+                                if self.pipelined_trigger_met(pending, loop_trigger.get('lag', 1)):
+                                    break
+                            elif loop_trigger and self.check_trigger(loop_trigger['function'],
+                                                                     loop_trigger['condition'],
+                                                                     loop_trigger['threshold'],
+                                                                     loop_trigger.get('roi')):
+                                break
+                            # check how much time has elapsed since start, calculate the wait time (if any)
+                            # if the loop took longer thant he outer loop says it should, immediately continue
+                            # for this also have to add one indent to the depth level for printing, as otherwise it is
+                            # less indented than the loop that was executed
+                            elapsed = time.time() - start_time
+                            wait_time = max(0, loop_interval - elapsed)
+                            if self.running and wait_time > 0:
+                                print(self.indent(depth + 1)
+                                      + f"Waiting {wait_time:.2f} seconds for nested loop interval.")
+                                time.sleep(wait_time)
+                            else:
+                                print(self.indent(depth + 1)
+                                      + f"{PrintColors.WARNING}Not waiting, as this nested loop took",
+                                      round(elapsed, 2),
+                                      f"seconds{PrintColors.ENDC}")
+                            if not self.running:
+                                break
+                    finally:
+                        if executor:
+                            # analyses of iterations after the loop has ended are not needed anymore
+                            executor.shutdown(wait=False, cancel_futures=True)
+                    continue
+            # increase the index for everything, except for loop start (this is handled above)
+            index += 1
+
+    def set_protocol(self, protocol):
+        # using the Andor function to set a protocol given the protocol name as a string
+        # if the protocol does not start or finish in time (or Fusion returns an error), the failure policy is used:
+        # skip: continue with the next step, retry: try again (up to the number of retries), abort: stop the loop
+        start_timeout = self.start_timeout or None
+        run_timeout = self.run_timeout or None
+        attempts = 1 + (self.retries if self.failure_policy == "retry" else 0)
+        for attempt in range(attempts):
+            try:
+                run_history.timed_protocol_run(protocol, lambda: self.client.run_protocol_completely(
+                    protocol, start_timeout, run_timeout))
+                # print(f"Running protocol: {protocol}")
+                return
+            except (fusionrest.StateTimeoutError, fusionrest.ApiError, Timeout) as e:
+                # a request Fusion did not answer in time is also handled by the failure policy (this is checked
+                # before ConnectionError, as a connect timeout is both)
+                print(self.indent(self.current_nesting)
+                      + f"{PrintColors.FAIL}Protocol {protocol} failed (attempt {attempt + 1} of {attempts}): "
+                      + f"{e}{PrintColors.ENDC}")
+                try:
+                    self.client.stop()
+                except (fusionrest.ApiError, ConnectionError, Timeout):
+                    # nothing is running that could be stopped (or no connection)
+                    pass
+            except ConnectionError:
+                print(self.indent(self.current_nesting)
+                      + f"{PrintColors.FAIL}No connection to microscope.{PrintColors.ENDC}")
+                return
+        if self.failure_policy == "abort":
+            print(self.indent(self.current_nesting) + f"{PrintColors.FAIL}Aborting the loop.{PrintColors.ENDC}")
+            self.running = False
+        else:
+            print(self.indent(self.current_nesting)
+                  + f"{PrintColors.WARNING}Skipping protocol {protocol}.{PrintColors.ENDC}")
+
+    def get_progress(self):
+        # print the progress in the console window
+        try:
+            progress = self.client.get_protocol_progress()
+            print(self.prefix + progress)
+        except (ConnectionError, Timeout):
+            print(self.indent(self.current_nesting) +
+                  f"{PrintColors.FAIL}No connection to microscope.{PrintColors.ENDC}")
+
+    def wait(self, waiting_time):
+        # wait for a certain amount of time (waiting time in s)
+        time.sleep(waiting_time)
+        return
+
+    def show_z_projection(self):
+        # calculate the z-projection of the last image that was acquired and hand it to `on_projection`
+        try:
+            z_proj = get_current_image_2d(path=self.client.get_current_image_path())
+            if self.on_projection:
+                self.on_projection(z_proj)
+        except (ConnectionError, Timeout):
+            print(self.indent(self.current_nesting)
+                  + f"{PrintColors.FAIL}No connection to microscope.{PrintColors.ENDC}")
+
+
+def run_in_parallel(runners):
+    """
+    Runs several queue runners (e.g. one per microscope, each with its own queue) at the same time and blocks until
+    all of them have finished.
+    """
+    for runner in runners:
+        runner.start()
+    for runner in runners:
+        runner.thread.join()
@@ -0,0 +1,115 @@
+"""
+Dry run of a queue: predicts how long a queue will take without using the microscope.
+
+Protocol durations, trigger probabilities and the time needed for checking triggers are taken from the run history
+(see `run_history.py`). The prediction uses expected values, e.g. an if-statement that was met in 30 % of the
+recorded checks adds 30 % of the duration of its body.
+"""
+import run_history
+
+default_protocol_duration = 60.0
+default_trigger_probability = 0.5
+
+
+def split_block(queue, index):
+    """
+    Gets the body of a loop or if-statement starting at `queue[index]`.
+    Returns the body and the index of the first item after the matching loop end.
+    """
+    body = []
+    nest = 1
+    index += 1
+    while index < len(queue) and nest > 0:
+        if queue[index]['type'] == 'loop_start':
+            nest += 1
+        elif queue[index]['type'] == 'loop_end':
+            nest -= 1
+        if nest > 0:
+            body.append(queue[index])
+        index += 1
+    return body, index
+
+
+class QueueSimulator:
+    """
+    Walks through a queue and adds up the expected durations. Warnings (protocols or triggers without history and
+    loops that can not keep their interval) are collected in `self.warnings`.
+    """
+    def __init__(self):
+        self.warnings = []
+
+    def protocol_duration(self, protocol):
+        duration = run_history.mean_protocol_duration(protocol)
+        if duration is None:
+            self.warnings.append(f"No history for protocol {protocol}, "
+                                 f"assuming {default_protocol_duration:.0f} s")
+            return default_protocol_duration
+        return duration
+
+    def trigger(self, trigger):
+        # returns the probability that the trigger is met and how long checking it takes
+        function = trigger.get('function', trigger.get('function_name'))
+        probability, duration = run_history.trigger_statistics(function, trigger['condition'], trigger['threshold'])
+        if probability is None:
+            self.warnings.append(f"No history for trigger {function} {trigger['condition']} {trigger['threshold']}, "
+                                 f"assuming it is met with probability {default_trigger_probability}")
+            return default_trigger_probability, 0.0
+        return probability, duration
+
+    def loop_duration(self, count, interval, iteration_duration, exit_probability, label, lag=0):
+        # each iteration takes at least the interval; with an exit trigger, iteration k+1 only runs with
+        # probability (1 - p) ** k (pipelined triggers exit up to `lag` iterations later)
+        if interval > 0 and iteration_duration > interval:
+            self.warnings.append(f"{label}: one iteration takes {iteration_duration:.1f} s, "
+                                 f"which is longer than the interval of {interval:.1f} s")
+        expected_iterations = sum((1 - exit_probability) ** max(0, k - lag) for k in range(count))
+        return expected_iterations * max(interval, iteration_duration)
+
+    def queue_duration(self, queue, depth=0):
+        duration = 0.0
+        index = 0
+        while index < len(queue):
+            item = queue[index]
+            if item['type'] == 'func':
+                action = item.get('action')
+                if action and action[0] == 'protocol':
+                    duration += self.protocol_duration(action[1])
+                elif action and action[0] == 'wait':
+                    duration += action[1]
+            elif item['type'] == 'loop_start':
+                body, index = split_block(queue, index)
+                loop_info = item['value']
+                if loop_info.get('is_conditional'):
+                    probability, check_duration = self.trigger(loop_info['trigger'])
+                    duration += check_duration + probability * self.queue_duration(body, depth + 1)
+                else:
+                    iteration_duration = self.queue_duration(body, depth + 1)
+                    exit_probability = 0.0
+                    lag = 0
+                    trigger = loop_info.get('trigger')
+                    if trigger:
+                        exit_probability, check_duration = self.trigger(trigger)
+                        if trigger.get('pipelined'):
+                            # the check runs during the next iteration, it only adds time if it takes longer
+                            lag = trigger.get('lag', 1)
+                            iteration_duration = max(iteration_duration, check_duration)
+                        else:
+                            iteration_duration += check_duration
+                    duration += self.loop_duration(loop_info.get('count', 1), loop_info.get('interval', 0),
+                                                   iteration_duration, exit_probability,
+                                                   f"Nested loop x{loop_info.get('count', 1)} (level {depth + 1})", lag)
+                continue
+            index += 1
+        return duration
+
+
+def simulate(queue, repeat_count, main_interval):
+    """
+    Predicts the total duration (in seconds) of running the queue `repeat_count` times with the main interval.
+    Returns the predicted duration and a list of warnings (e.g. intervals that can not be kept).
+    """
+    simulator = QueueSimulator()
+    queue_duration = simulator.queue_duration(queue)
+    total_duration = simulator.loop_duration(repeat_count, main_interval, queue_duration, 0.0, "Main loop")
+    # remove duplicates, but keep the order
+    return total_duration, list(dict.fromkeys(simulator.warnings))
@@ -0,0 +1,83 @@
+"""
+Local SQLite history of protocol run times and trigger results.
+
+Every protocol that is run completely and every trigger that is checked is recorded, so the durations of protocols and
+the probabilities of triggers being met can be used to predict the run time of a queue (see `queue_simulator.py`).
+"""
+import os
+import time
+import sqlite3
+
+database_path = os.path.join(os.path.expanduser("~"), ".dragonfly_looper_history.sqlite")
+enabled = True
+
+
+def _connect():
+    connection = sqlite3.connect(database_path)
+    connection.execute("CREATE TABLE IF NOT EXISTS protocol_runs "
+                       "(protocol TEXT, start_time REAL, duration REAL)")
+    connection.execute("CREATE TABLE IF NOT EXISTS trigger_results "
+                       "(function TEXT, condition TEXT, threshold REAL, met INTEGER, start_time REAL, duration REAL)")
+    return connection
+
+
+def _record(statement, values):
+    # the history is only used for predictions, so failing to write it (e.g. "database is locked" while another
+    # runner or process writes) only prints a warning and never changes how the queue runs
+    if not enabled:
+        return
+    try:
+        with _connect() as connection:
+            connection.execute(statement, values)
+        connection.close()
+    except sqlite3.Error as e:
+        print(f"Warning: could not record the run history: {e}")
+
+
+def record_protocol_run(protocol, start_time, duration):
+    """
+    Stores how long running a protocol took (in seconds).
+    """
+    _record("INSERT INTO protocol_runs VALUES (?, ?, ?)", (protocol, start_time, duration))
+
+
+def record_trigger_result(function, condition, threshold, met, start_time, duration):
+    """
+    Stores if a trigger was met and how long checking it took (in seconds).
+    """
+    _record("INSERT INTO trigger_results VALUES (?, ?, ?, ?, ?, ?)",
+            (function, condition, threshold, int(met), start_time, duration))
+
+
+def mean_protocol_duration(protocol):
+    """
+    Returns the mean duration of all recorded runs of a protocol in seconds, or None if it was never recorded.
+    """
+    with _connect() as connection:
+        value, = connection.execute("SELECT AVG(duration) FROM protocol_runs WHERE protocol = ?",
+                                    (protocol,)).fetchone()
+    connection.close()
+    return value
+
+
+def trigger_statistics(function, condition, threshold):
+    """
+    Returns the fraction of checks in which a trigger was met and the mean duration of checking it in seconds.
+    Both are None if the trigger was never recorded with this condition and threshold.
+    """
+    with _connect() as connection:
+        probability, duration = connection.execute(
+            "SELECT AVG(met), AVG(duration) FROM trigger_results WHERE function = ? AND condition = ? AND threshold = ?",
+            (function, condition, threshold)).fetchone()
+    connection.close()
+    return probability, duration
+
+
+def timed_protocol_run(protocol, run_function):
+    """
+    Runs `run_function()` and records its duration as a run of the protocol, if it finished without an error.
+    """
+    start_time = time.time()
+    result = run_function()
+    record_protocol_run(protocol, start_time, time.time() - start_time)
+    return result
@@ -0,0 +1,88 @@
+"""
+Writes synthetic images with the layout of Imaris (.ims) files, e.g. for benchmarks without a microscope.
+
+The images contain a noisy background with some bright spots, so they compress roughly like real images.
+Only the parts of the Imaris layout used by `get_current_image.py` are written:
+DataSet/ResolutionLevel <l>/TimePoint 0/Channel <c>/Data and the sizes and extents in DataSetInfo/Image.
+"""
+import argparse
+import h5py
+import numpy as np
+
+
+def _imaris_attribute(value):
+    # imaris stores attributes as arrays of single characters, e.g. [b'5', b'1', b'2']
+    return np.array(list(str(value)), dtype="S1")
+
+
+def synthetic_volume(shape, dtype="uint16", n_spots=50, seed=0):
+    """
+    Creates a 3D image (shape: z, y, x as on disk) with a noisy background and bright gaussian spots.
+    """
+    rng = np.random.default_rng(seed)
+    dtype = np.dtype(dtype)
+    max_value = np.iinfo(dtype).max if dtype.kind in "ui" else 1.0
+    img = rng.normal(0.05 * max_value, 0.01 * max_value, size=shape).astype(np.float32)
+    # add the spots only in a small box around each centre, so this stays fast for large images
+    radius = 4
+    for centre in zip(*(rng.integers(0, size, n_spots) for size in shape)):
+        box = tuple(slice(max(c - 3 * radius, 0), min(c + 3 * radius + 1, size)) for c, size in zip(centre, shape))
+        grids = np.ogrid[box]
+        distance_squared = sum((grid - c) ** 2 for grid, c in zip(grids, centre))
+        img[box] += 0.8 * max_value * np.exp(-distance_squared / (2 * radius ** 2))
+    return np.clip(img, 0, max_value).astype(dtype)
+
+
+def write_synthetic_ims(path, shape=(32, 512, 512), dtype="uint16", chunks=(16, 128, 128), compression="gzip",
+                        compression_opts=2, n_channels=1, n_resolution_levels=1, pixel_size=(1.0, 0.5, 0.5),
+                        seed=0):
+    """
+
+    Write a synthetic image in the imaris layout.
+
+    :param path: str, path of the .ims file to write
+    :param shape: tuple, size of the image on disk (z, y, x)
+    :param dtype: str or np.dtype, data type of the image
+    :param chunks: tuple or None, chunk shape (z, y, x), None for a contiguous data set (with compression, h5py then
+        chooses the chunks automatically)
+    :param compression: str or None, h5py compression filter (e.g. "gzip", "lzf" or None)
+    :param compression_opts: int or None, compression level (only used for gzip)
+    :param n_channels: int, number of channels
+    :param n_resolution_levels: int, number of resolution levels, each level is downsampled by 2 in all axes
+    :param pixel_size: tuple, pixel size (z, y, x), used for the extents
+    :param seed: int, seed of the random number generator
+    :return: str, path of the written file
+
+    """
+    with h5py.File(path, "w") as h5file:
+        for channel in range(n_channels):
+            img = synthetic_volume(shape, dtype, seed=seed + channel)
+            for level in range(n_resolution_levels):
+                level_chunks = None if chunks is None else tuple(min(c, s) for c, s in zip(chunks, img.shape))
+                group = h5file.require_group(f"DataSet/ResolutionLevel {level}/TimePoint 0/Channel {channel}")
+                group.create_dataset("Data", data=img, chunks=level_chunks, compression=compression,
+                                     compression_opts=compression_opts if compression == "gzip" else None)
+                img = img[::2, ::2, ::2]
+        info = h5file.require_group("DataSetInfo/Image")
+        for dim, (name, size, pixel) in enumerate(zip("ZYX", shape, pixel_size)):
+            axis = 2 - dim  # imaris counts the axes as x = 0, y = 1, z = 2
+            info.attrs[name] = _imaris_attribute(size)
+            info.attrs[f"ExtMin{axis}"] = _imaris_attribute(0)
+            info.attrs[f"ExtMax{axis}"] = _imaris_attribute(size * pixel)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic image in the imaris (.ims) layout.")
+    parser.add_argument("path")
+    parser.add_argument("--shape", type=int, nargs=3, default=(32, 512, 512), metavar=("Z", "Y", "X"))
+    parser.add_argument("--dtype", default="uint16")
+    parser.add_argument("--chunks", type=int, nargs=3, default=(16, 128, 128), metavar=("Z", "Y", "X"))
+    parser.add_argument("--compression", default="gzip", help="gzip, lzf or none")
+    parser.add_argument("--channels", type=int, default=1)
+    parser.add_argument("--resolution-levels", type=int, default=1)
+    args = parser.parse_args()
+    write_synthetic_ims(args.path, tuple(args.shape), args.dtype, tuple(args.chunks),
+                        None if args.compression == "none" else args.compression,
+                        n_channels=args.channels, n_resolution_levels=args.resolution_levels)
+    print("Written", args.path)
@@ -1,15 +1,21 @@
-from get_current_image import get_current_image_3d
+from trigger_registry import register_trigger
 import numpy as np
 
+# Trigger functions registered with @register_trigger get the image data they declare (by default the 3D image of
+# the first channel, shape (x, y, z)) and return a number. Plain functions without arguments also work, they have to
+# load the image themselves (e.g. with get_current_image_3d from get_current_image.py).
 
-def image_max_intensity_trigger():
+
+@register_trigger(data="volume")
+def image_max_intensity_trigger(img):
     # returns the maximum of the last image (calculated in 3D)
-    return np.max(get_current_image_3d())
+    return np.max(img)
 
 
-def image_99_perc_trigger():
+@register_trigger(data="volume")
+def image_99_perc_trigger(img):
     # returns the 99 percentile of the last image (calculated in 3D)
-    return np.percentile(get_current_image_3d(), 99)
+    return np.percentile(img, 99)
 
 
 """
@@ -0,0 +1,233 @@
+"""
+Registry of trigger functions and the image data they need.
+
+Trigger functions in `trigger_functions.py` can be registered with `register_trigger`, declaring which data they need
+(3D volume or z-projection, channel, resolution level and an optional region of interest). They then get this data as
+their only argument instead of loading the image themselves. All triggers evaluated on the same image share one
+`ImageData`, so every piece of data is only read once, and their results are cached (see `image_cache.py`).
+
+Plain functions in `trigger_functions.py` (without arguments, or with `roi` and/or `path` keyword arguments) still
+work as before.
+"""
+import os
+import json
+import hashlib
+import inspect
+import threading
+import numpy as np
+import image_cache
+from get_current_image import imaris_image_reader, imaris_projection, get_current_image_2d
+
+_triggers = {}  # registered triggers by name, in the order they were registered
+
+
+class DataRequirements:
+    """
+    Describes the image data a trigger function needs.
+
+    * data: "volume" (3D image, shape (x, y, z)) or "projection" (z-projection, shape (x, y))
+    * projection: "max", "mean" or "sum", how the z-projection is calculated (only used for "projection")
+    * channel: channel of the image
+    * resolution_level: resolution level of the image (0 is the highest resolution)
+    * roi: region of interest, see `get_current_image.roi_to_slices` (None for the whole image)
+    """
+    def __init__(self, data="volume", channel=0, resolution_level=0, roi=None, projection="max"):
+        if data not in ("volume", "projection"):
+            raise ValueError(f"Unknown trigger data: {data}")
+        if projection not in ("max", "mean", "sum"):
+            raise ValueError(f"Unknown projection: {projection}")
+        self.data = data
+        self.projection = projection if data == "projection" else None
+        self.channel = channel
+        self.resolution_level = resolution_level
+        self.roi = roi
+
+    def with_roi(self, roi):
+        # the same requirements, but restricted to another roi (e.g. the one given in the GUI)
+        return DataRequirements(self.data, self.channel, self.resolution_level, roi, self.projection or "max")
+
+    def key(self):
+        return (self.data, self.projection, self.channel, self.resolution_level, json.dumps(self.roi, sort_keys=True))
+
+    def __repr__(self):
+        # the max projection is written as before, so cached trigger results stay valid
+        data = self.data if self.projection in (None, "max") else f"{self.projection} {self.data}"
+        text = f"{data} c{self.channel} l{self.resolution_level}"
+        if self.roi is not None:
+            text += " roi " + json.dumps(self.roi, sort_keys=True)
+        return text
+
+
+class ImageData:
+    """
+    Loads the data of one image as requested by triggers. Everything that was loaded once is kept, so triggers
+    evaluated on the same image share it.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.stamp = self.file_stamp(path)
+        self._data = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def file_stamp(path):
+        # modification time and size, to notice if Fusion overwrites an image with the same name
+        try:
+            stat = os.stat(path)
+            return stat.st_mtime_ns, stat.st_size
+        except (OSError, TypeError):
+            return None
+
+    def is_current(self, path):
+        # checks if this is still the data of the image at this path
+        return path is not None and path == self.path and self.stamp == self.file_stamp(path)
+
+    def get(self, requirements):
+        key = requirements.key()
+        with self._lock:
+            if key not in self._data:
+                self._data[key] = self._load(requirements)
+            return self._data[key]
+
+    def _load(self, requirements):
+        if requirements.data == "projection":
+            if (requirements.projection, requirements.channel, requirements.resolution_level,
+                    requirements.roi) == ("max", 0, 0, None):
+                # this is the z-projection that is also shown in the GUI, so it is cached on disk
+                return get_current_image_2d(path=self.path)
+            volume_key = DataRequirements("volume", requirements.channel, requirements.resolution_level,
+                                          requirements.roi).key()
+            if volume_key in self._data:
+                # another trigger already needed the volume
+                return getattr(np, requirements.projection)(self._data[volume_key], axis=2)
+            # otherwise the projection is calculated while reading, without loading the whole volume
+            print("Projecting image", self.path, requirements)
+            return imaris_projection(self.path, requirements.projection, roi=requirements.roi,
+                                     channel=requirements.channel, resolution_level=requirements.resolution_level)
+        print("Loading image", self.path, requirements)
+        return imaris_image_reader(self.path, roi=requirements.roi, channel=requirements.channel,
+                                   resolution_level=requirements.resolution_level)
+
+
+def _code_fingerprint(code):
+    # bytecode and constants of a function, nested functions (e.g. lambdas) by their own fingerprint, as their repr
+    # contains a memory address
+    digest = hashlib.sha1(code.co_code)
+    for const in code.co_consts:
+        digest.update((_code_fingerprint(const) if inspect.iscode(const) else repr(const)).encode())
+    return digest.hexdigest()[:12]
+
+
+class Trigger:
+    """
+    A registered trigger function with the data it needs.
+    """
+    def __init__(self, function, requirements, cache):
+        self.function = function
+        self.requirements = requirements
+        self.cache = cache
+        # cached values belong to this version of the function, so after editing it they are calculated again
+        self.fingerprint = _code_fingerprint(function.__code__)
+
+    def evaluate(self, image_data, roi=None):
+        # a roi given for this evaluation (e.g. in the GUI) replaces the roi the trigger was registered with
+        requirements = self.requirements if roi is None else self.requirements.with_roi(roi)
+        if not self.cache:
+            return self.function(image_data.get(requirements))
+        return image_cache.get_statistic(image_data.path,
+                                         f"{self.function.__name__} {self.fingerprint} {requirements}",
+                                         lambda: self.function(image_data.get(requirements)))
+
+
+def register_trigger(data="volume", channel=0, resolution_level=0, roi=None, cache=True, projection="max"):
+    """
+    Decorator to register a trigger function. The function gets the requested image data (np.array) and returns
+    a number, e.g.:
+
+        @register_trigger(data="projection", channel=1)
+        def my_trigger(projection):
+            return np.mean(projection)
+
+    With data="projection", `projection` selects the "max", "mean" or "sum" z-projection.
+
+    If `cache` is True, the result is cached for every image, so only use it for functions that always give the same
+    result for the same data.
+    """
+    requirements = DataRequirements(data, channel, resolution_level, roi, projection)
+
+    def decorator(function):
+        _triggers[function.__name__] = Trigger(function, requirements, cache)
+        return function
+    return decorator
+
+
+def _legacy_functions():
+    # plain functions defined in trigger_functions.py (not imported ones and not registered ones)
+    import trigger_functions
+    return {
+        name: func for name, func in trigger_functions.__dict__.items()
+        if inspect.isfunction(func) and func.__module__ == trigger_functions.__name__
+        and not name.startswith("_") and name not in _triggers
+    }
+
+
+def registered_triggers():
+    """
+    Returns the names of all trigger functions registered with `register_trigger`.
+    """
+    import trigger_functions  # registers the triggers
+    return list(_triggers)
+
+
+def available_triggers():
+    """
+    Returns the names of all trigger functions (registered ones first) for the dropdown menus.
+    """
+    import trigger_functions  # registers the triggers
+    return list(_triggers) + list(_legacy_functions())
+
+
+def accepts_path(name):
+    """
+    Checks if a trigger can analyze a given image (instead of the current image of the default microscope).
+    """
+    import trigger_functions  # registers the triggers
+    if name in _triggers:
+        return True
+    func = _legacy_functions().get(name)
+    return func is not None and 'path' in inspect.signature(func).parameters
+
+
+def accepts_roi(name):
+    """
+    Checks if a trigger can be restricted to a region of interest.
+    """
+    import trigger_functions  # registers the triggers
+    if name in _triggers:
+        return True
+    func = _legacy_functions().get(name)
+    return func is not None and 'roi' in inspect.signature(func).parameters
+
+
+def evaluate(name, image_data, roi=None):
+    """
+    Evaluates a trigger function on an image and returns its value.
+
+    :param name: str, name of the trigger function
+    :param image_data: ImageData, the image, shared by all triggers evaluated on this image
+    :param roi: dict or None, region of interest replacing the one the trigger was registered with
+    :return: number, value of the trigger function
+    """
+    import trigger_functions  # registers the triggers
+    if name in _triggers:
+        return _triggers[name].evaluate(image_data, roi)
+    # plain function, it loads the image itself
+    func = getattr(trigger_functions, name)
+    kwargs = {}
+    if roi:
+        if 'roi' not in inspect.signature(func).parameters:
+            raise TypeError(f"{name} does not accept a region of interest")
+        kwargs['roi'] = roi
+    if image_data.path is not None and 'path' in inspect.signature(func).parameters:
+        kwargs['path'] = image_data.path
+    return func(**kwargs)